@@ -20,4 +20,24 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
-__all__ = ["program", "scripting", "utilities"]
+__all__ = [
+    "archive",
+    "commands",
+    "course",
+    "dedup",
+    "events",
+    "export",
+    "fit",
+    "fsck",
+    "index",
+    "migration",
+    "monitoring",
+    "pipeline",
+    "profiling",
+    "program",
+    "scripting",
+    "search",
+    "server",
+    "storage",
+    "utilities",
+]
@@ -0,0 +1,256 @@
+# Archive
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import array
+import json
+import logging
+import os
+import re
+
+from . import migration
+from . import storage
+from . import utilities
+
+_logger = logging.getLogger()
+
+
+class FileType:
+    """FIT file types, same values as ant.fs.file.File.Identifier
+
+    Kept here so that the archive can be used without openant.
+    """
+
+    DEVICE = 1
+    SETTING = 2
+    SPORT = 3
+    ACTIVITY = 4
+    WORKOUT = 5
+    COURSE = 6
+    SCHEDULES = 7
+    WAYPOINTS = 8
+    WEIGHT = 9
+    TOTALS = 10
+    GOALS = 11
+    BLOOD_PRESSURE = 14
+    MONITORING_A = 15
+    ACTIVITY_SUMMARY = 20
+    MONITORING_DAILY = 28
+    MONITORING_B = 32
+
+
+_directories = {
+    ".": FileType.DEVICE,
+    "activities": FileType.ACTIVITY,
+    "courses": FileType.COURSE,
+    "waypoints": FileType.WAYPOINTS,
+    "monitoring_b": FileType.MONITORING_B,
+    # "profile":     FileType.?
+    # "goals?":      FileType.GOALS,
+    # "bloodprs":    FileType.BLOOD_PRESSURE,
+    # "summaries":   FileType.ACTIVITY_SUMMARY,
+    "settings": FileType.SETTING,
+    "sports": FileType.SPORT,
+    "totals": FileType.TOTALS,
+    "weight": FileType.WEIGHT,
+    "workouts": FileType.WORKOUT,
+}
+
+_filetypes = dict((v, k) for (k, v) in _directories.items())
+
+
+@migration.migration(0, "sort FIT files into a folder per file type")
+def _migrate_sort_by_type(transaction, path):
+    for filename in sorted(os.listdir(path)):
+        match = re.match(r"^.*_(\d+)_\d+\.fit$", filename, re.IGNORECASE)
+        if match is None or int(match.group(1)) not in _filetypes:
+            continue
+        folder = _filetypes[int(match.group(1))]
+        if folder != ".":
+            transaction.makedirs(os.path.join(path, folder))
+            transaction.rename(
+                os.path.join(path, filename), os.path.join(path, folder, filename)
+            )
+
+
+class Device:
+    class ProfileVersionException(Exception):
+        pass
+
+    _PROFILE_VERSION = 1
+    _PROFILE_VERSION_FILE = "profile_version"
+    _LAYOUT_FILE = "layout"
+    _CHANNEL_FILE = "channel.json"
+
+    def __init__(self, basedir, serial, name, compression=None, layout=None):
+        self._path = os.path.join(basedir, str(serial))
+        self._serial = serial
+        self._name = name
+
+        # Check profile version, if not a new device
+        if os.path.isdir(self._path):
+            migration.recover(self._path)
+            if self.get_profile_version() < self._PROFILE_VERSION:
+                self.upgrade()
+            elif self.get_profile_version() > self._PROFILE_VERSION:
+                raise Device.ProfileVersionException(
+                    "Profile version mismatch, too new"
+                )
+
+        # Create directories
+        utilities.makedirs_if_not_exists(self._path)
+        for directory in _directories:
+            directory_path = os.path.join(self._path, directory)
+            utilities.makedirs_if_not_exists(directory_path)
+
+        # Write profile version (If none)
+        path = os.path.join(self._path, self._PROFILE_VERSION_FILE)
+        if not os.path.exists(path):
+            with open(path, "w") as f:
+                f.write(str(self._PROFILE_VERSION))
+
+        # Remember the layout, if changed
+        if layout is not None and layout != self.get_layout():
+            with open(os.path.join(self._path, self._LAYOUT_FILE), "w") as f:
+                f.write(layout)
+
+        self._storage = storage.Storage(self._path, compression, self.get_layout())
+
+    def get_path(self):
+        return self._path
+
+    def get_serial(self):
+        return self._serial
+
+    def get_name(self):
+        return self._name
+
+    def get_storage(self):
+        return self._storage
+
+    def get_layout(self):
+        return get_layout(self._path)
+
+    def get_migration(self):
+        """Background migration of the files to the current layout"""
+        return storage.Migration(self._storage, list(_directories))
+
+    def upgrade(self, dry_run=False):
+        """Migrate the device folder to the current profile version"""
+        try:
+            return upgrade(self._path, dry_run)
+        except migration.MigrationError as e:
+            raise Device.ProfileVersionException(
+                "Profile version mismatch, too old ({0})".format(e)
+            )
+
+    def get_profile_version(self):
+        return get_profile_version(self._path)
+
+    def read_passkey(self):
+        try:
+            with open(os.path.join(self._path, "authfile"), "rb") as f:
+                d = array.array("B", f.read())
+                _logger.debug("loaded authfile: %r", d)
+                return d
+        except:
+            return None
+
+    def write_passkey(self, passkey):
+        with open(os.path.join(self._path, "authfile"), "wb") as f:
+            passkey.tofile(f)
+            _logger.debug("wrote authfile: %r, %r", self._serial, passkey)
+
+    def read_channel(self):
+        return read_channel(self._path)
+
+    def write_channel(self, parameters):
+        """Remember the channel parameters the device was found with"""
+        path = os.path.join(self._path, self._CHANNEL_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(parameters, f)
+        os.replace(path + ".tmp", path)
+
+
+def get_devices(basedir):
+    """Return the serials of all device folders"""
+    try:
+        names = os.listdir(basedir)
+    except OSError:
+        return []
+    return sorted(
+        int(name)
+        for name in names
+        if name.isdigit() and os.path.isdir(os.path.join(basedir, name))
+    )
+
+
+def get_serial(filename, folder):
+    """Serial of the device a file of folder belongs to, from its path
+
+    Works for stored files, also in date folders, and for the plain copies
+    of storage.Storage.local_path. Returns None if folder is not in the path.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    while os.path.basename(directory) != folder:
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+    return os.path.basename(os.path.dirname(directory))
+
+
+def get_profile_version(path):
+    path = os.path.join(path, Device._PROFILE_VERSION_FILE)
+    try:
+        with open(path, "rb") as f:
+            return int(f.read())
+    except IOError as e:
+        # TODO
+        return 0
+
+
+def get_layout(path):
+    try:
+        with open(os.path.join(path, Device._LAYOUT_FILE), "r") as f:
+            return f.read().strip()
+    except IOError:
+        return "flat"
+
+
+def read_channel(path):
+    """Channel parameters the device was last found with, or None"""
+    try:
+        with open(os.path.join(path, Device._CHANNEL_FILE), "r") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def upgrade(path, dry_run=False):
+    """Migrate a device folder to the current profile version"""
+    return migration.upgrade(
+        path,
+        get_profile_version(path),
+        Device._PROFILE_VERSION,
+        Device._PROFILE_VERSION_FILE,
+        dry_run,
+    )
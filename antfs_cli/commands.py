@@ -0,0 +1,466 @@
+# Commands
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+# Commands working on the local archive only. They are dispatched before
+# the program module is imported, so they run without openant or an ANT
+# USB stick.
+
+import calendar
+import datetime
+import logging
+import os
+import sys
+from argparse import ArgumentParser, ArgumentTypeError
+
+from . import archive
+from . import course
+from . import dedup
+from . import export
+from . import fsck
+from . import index
+from . import migration
+from . import monitoring
+from . import server
+from . import storage
+from . import utilities
+
+_logger = logging.getLogger()
+
+PRODUCT_NAME = "antfs-cli"
+
+
+def _get_paths(config_dir, serials):
+    return [
+        os.path.join(config_dir, str(serial))
+        for serial in serials or archive.get_devices(config_dir)
+    ]
+
+
+def _check_devices(config_dir, serials):
+    """Report serials without a device folder, return False if any"""
+    devices = archive.get_devices(config_dir)
+    missing = [serial for serial in serials or [] if serial not in devices]
+    for serial in missing:
+        print(os.path.join(config_dir, str(serial)), "- no such device")
+    return not missing
+
+
+def _describe(operation):
+    if operation["op"] == "rename":
+        return "rename {0} to {1}".format(operation["src"], operation["dst"])
+    return "{0} {1}".format(operation["op"], operation["path"])
+
+
+def _migrate(config_dir, args):
+    failed = False
+    for path in _get_paths(config_dir, args.serial):
+        if not os.path.isdir(path):
+            print(path, "- no such device")
+            failed = True
+            continue
+        if args.rollback:
+            if migration.recover(path):
+                print(path, "- rolled back interrupted migration")
+            continue
+        if not args.dry_run:
+            migration.recover(path)
+        version = archive.get_profile_version(path)
+        print(path, "- profile version", version)
+        try:
+            steps = archive.upgrade(path, args.dry_run)
+        except migration.MigrationError as e:
+            print(" - Failed:", e)
+            failed = True
+            continue
+        for version, description, operations in steps:
+            print(" - Version {0}: {1}".format(version + 1, description))
+            for operation in operations:
+                print("   ", _describe(operation))
+    return 1 if failed else 0
+
+
+def _add_migrate(subparsers):
+    parser = subparsers.add_parser(
+        "migrate", help="upgrade device folders to the current profile version"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only show what would be done"
+    )
+    parser.add_argument(
+        "--rollback",
+        action="store_true",
+        help="only roll back a migration step that was interrupted, as is "
+        "also done whenever the device is opened, and do not upgrade",
+    )
+    parser.add_argument(
+        "serial", nargs="*", type=int, help="devices to migrate, default all"
+    )
+    parser.set_defaults(function=_migrate)
+    return parser
+
+
+def _fsck(config_dir, args):
+    def report(path, error):
+        if error is not None:
+            print(path, "-", error)
+        elif args.verbose:
+            print(path, "- OK")
+
+    if not _check_devices(config_dir, args.serial):
+        return 1
+    bad = fsck.fsck(
+        config_dir, args.serial, args.jobs, not args.no_repair, callback=report
+    )
+    if bad and not args.no_repair:
+        print(
+            len(bad),
+            "bad file(s) renamed to *{0}, they will be downloaded again on "
+            "the next sync".format(fsck.CORRUPT_SUFFIX),
+        )
+    return 1 if bad else 0
+
+
+def _add_fsck(subparsers):
+    parser = subparsers.add_parser(
+        "fsck", help="check the header and CRC of all stored FIT files"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, help="number of processes, default one per CPU"
+    )
+    parser.add_argument(
+        "--no-repair",
+        action="store_true",
+        help="only report bad files, don't mark them for download",
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="list good files too"
+    )
+    parser.add_argument(
+        "serial", nargs="*", type=int, help="devices to check, default all"
+    )
+    parser.set_defaults(function=_fsck)
+    return parser
+
+
+def _course(config_dir, args):
+    compiler = course.Compiler(config_dir, args.tolerance, args.speed)
+    failed = False
+    for filename in args.file:
+        try:
+            path = compiler.add(args.serial, filename, args.name, args.force)
+        except (course.CourseError, IOError) as e:
+            print(filename, "-", e)
+            failed = True
+            continue
+        if path is None:
+            print(filename, "- already added, use --force to add again")
+        else:
+            print(filename, "->", path)
+    return 1 if failed else 0
+
+
+def _add_course(subparsers):
+    parser = subparsers.add_parser(
+        "course",
+        help="convert GPX or TCX routes to FIT courses, sent with --upload",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=5.0,
+        help="drop points closer than this to the simplified route, in "
+        "meters, default 5",
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=15.0,
+        help="speed in km/h for routes without times, default 15",
+    )
+    parser.add_argument("--name", help="course name, default from the file")
+    parser.add_argument(
+        "--force", action="store_true", help="add courses added before again"
+    )
+    parser.add_argument("serial", type=int, help="device to add the courses to")
+    parser.add_argument("file", nargs="+", help="GPX or TCX files")
+    parser.set_defaults(function=_course)
+    return parser
+
+
+def _dedup(config_dir, args):
+    def report(duplicate, original):
+        if args.verbose:
+            print(duplicate, "->", original)
+
+    if not _check_devices(config_dir, args.serial):
+        return 1
+    files, saved = dedup.dedup(
+        config_dir, args.serial, args.method, args.dry_run, callback=report
+    )
+    print(
+        "{0} {1} duplicate file(s), {2} bytes".format(
+            "Would link" if args.dry_run else "Linked", files, saved
+        )
+    )
+    return 0
+
+
+def _add_dedup(subparsers):
+    parser = subparsers.add_parser(
+        "dedup", help="replace identical files of all devices by links to one copy"
+    )
+    parser.add_argument(
+        "--method",
+        choices=dedup.METHODS,
+        default="hardlink",
+        help="link with hardlinks (default) or reflinks (copy on write clones)",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only show what would be done"
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="list the linked files"
+    )
+    parser.add_argument(
+        "serial", nargs="*", type=int, help="devices to compare, default all"
+    )
+    parser.set_defaults(function=_dedup)
+    return parser
+
+
+def _export(config_dir, args):
+    if not _check_devices(config_dir, args.serial):
+        return 1
+    try:
+        exporter = export.Exporter(config_dir, args.output, args.format)
+    except export.ExportError as e:
+        print("Error:", e)
+        return 1
+    for partition in exporter.update(args.serial):
+        print(partition)
+    return 0
+
+
+def _add_export(subparsers):
+    parser = subparsers.add_parser(
+        "export", help="export activity records to columnar files"
+    )
+    parser.add_argument(
+        "--format", choices=["npz", "parquet"], default="npz", help="file format"
+    )
+    parser.add_argument("--output", help="export directory, default <config>/export")
+    parser.add_argument(
+        "serial", nargs="*", type=int, help="devices to export, default all"
+    )
+    parser.set_defaults(function=_export)
+    return parser
+
+
+def _day(value):
+    # Validated, but kept as text to compare with the dates in the index
+    datetime.datetime.strptime(value, "%Y-%m-%d")
+    return value
+
+
+def _date(value):
+    return calendar.timegm(datetime.datetime.strptime(value, "%Y-%m-%d").timetuple())
+
+
+def _monitoring(config_dir, args):
+    if args.start is not None and args.serial is None:
+        print("Error: --from needs a device serial")
+        return 1
+    if not _check_devices(config_dir, args.serial and [args.serial]):
+        return 1
+    store = monitoring.MonitoringStore(config_dir)
+    added = store.update(args.serial and [args.serial])
+    if args.start is None:
+        print(added, "new sample(s)")
+        return 0
+    end = args.end if args.end is not None else args.start
+    print(",".join(name for name, _, _, _ in monitoring.FIELDS))
+    for sample in store.query(args.serial, args.start, end + 24 * 60 * 60):
+        print(
+            ",".join(
+                "" if value == invalid else str(value)
+                for value, (_, _, _, invalid) in zip(sample, monitoring.FIELDS)
+            )
+        )
+    return 0
+
+
+def _add_monitoring(subparsers):
+    parser = subparsers.add_parser(
+        "monitoring",
+        help="merge monitoring files into a daily time series and query it",
+    )
+    parser.add_argument(
+        "--from", dest="start", type=_date, help="print samples from YYYY-MM-DD (UTC)"
+    )
+    parser.add_argument(
+        "--to",
+        dest="end",
+        type=_date,
+        help="print samples up to and including YYYY-MM-DD",
+    )
+    parser.add_argument(
+        "serial", nargs="?", type=int, help="device to update, default all"
+    )
+    parser.set_defaults(function=_monitoring)
+    return parser
+
+
+def _type(value):
+    if value.isdigit():
+        return int(value)
+    if value not in archive._directories:
+        raise ArgumentTypeError(
+            "unknown type {0}, use a number or one of {1}".format(
+                value, ", ".join(sorted(archive._directories))
+            )
+        )
+    return archive._directories[value]
+
+
+def _ls(config_dir, args):
+    if not _check_devices(config_dir, args.serial):
+        return 1
+    files = index.Index(config_dir)
+    if args.rescan:
+        files.update(args.serial, rescan=True)
+    end = index.next_day(args.until) if args.until is not None else None
+    stores = {}
+    for serial, folder, name, fit_type, date, size in files.query(
+        args.serial, args.type, args.since, end, args.min_size, args.max_size
+    ):
+        if serial not in stores:
+            path = os.path.join(config_dir, str(serial))
+            stores[serial] = storage.Storage(path, layout=archive.get_layout(path))
+        if not stores[serial].exists(folder, name):
+            # Removed or renamed since indexed, e.g. by fsck
+            files.remove(serial, folder, name)
+            continue
+        path = stores[serial].get_path(folder, name)
+        if args.long:
+            print(serial, fit_type, date or "-" * 19, "{0:>9}".format(size), path)
+        else:
+            print(path)
+    return 0
+
+
+def _add_ls(subparsers):
+    parser = subparsers.add_parser(
+        "ls", help="list stored files, using an index of the archive"
+    )
+    parser.add_argument(
+        "-t",
+        "--type",
+        action="append",
+        type=_type,
+        help="FIT file type, a number or a folder name like activities, "
+        "can be repeated",
+    )
+    parser.add_argument("--since", type=_day, help="files from YYYY-MM-DD on")
+    parser.add_argument("--until", type=_day, help="files up to YYYY-MM-DD")
+    parser.add_argument("--min-size", type=int, help="minimum stored size in bytes")
+    parser.add_argument("--max-size", type=int, help="maximum stored size in bytes")
+    parser.add_argument(
+        "-l", "--long", action="store_true", help="show serial, type, date and size"
+    )
+    parser.add_argument(
+        "--rescan", action="store_true", help="rebuild the index of the devices"
+    )
+    parser.add_argument(
+        "serial", nargs="*", type=int, help="devices to list, default all"
+    )
+    parser.set_defaults(function=_ls)
+    return parser
+
+
+def _serve(config_dir, args):
+    httpd = server.Server(config_dir, (args.host, args.port))
+    print(
+        "Serving {0} on http://{1}:{2}/devices".format(
+            config_dir, *httpd.server_address[:2]
+        )
+    )
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+    return 0
+
+
+def _add_serve(subparsers):
+    parser = subparsers.add_parser(
+        "serve", help="serve the archive read-only over HTTP"
+    )
+    parser.add_argument(
+        "--host", default="127.0.0.1", help="address to listen on, default 127.0.0.1"
+    )
+    parser.add_argument(
+        "--port", type=int, default=8610, help="port to listen on, default 8610"
+    )
+    parser.set_defaults(function=_serve)
+    return parser
+
+
+_commands = {
+    "course": _add_course,
+    "dedup": _add_dedup,
+    "export": _add_export,
+    "fsck": _add_fsck,
+    "ls": _add_ls,
+    "migrate": _add_migrate,
+    "monitoring": _add_monitoring,
+    "serve": _add_serve,
+}
+
+
+def get_commands():
+    return sorted(_commands)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in _commands:
+        from . import program
+
+        return program.main()
+
+    parser = ArgumentParser(
+        prog=PRODUCT_NAME, description="Works on the local FIT file archive."
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    for add_parser in _commands.values():
+        subparser = add_parser(subparsers)
+        subparser.add_argument("--debug", action="store_true", help="enable debug")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+
+    config_dir = utilities.XDG(PRODUCT_NAME).get_config_dir()
+    # Created by the first sync, but the index and caches live here too
+    utilities.makedirs_if_not_exists(config_dir)
+    return args.function(config_dir, args)
@@ -0,0 +1,367 @@
+# Course
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import calendar
+import datetime
+import hashlib
+import json
+import math
+import os
+import re
+import xml.etree.ElementTree as ElementTree
+
+from . import archive
+from . import fit
+from . import index
+from . import storage
+from . import utilities
+
+FILE_ID_MESSAGE = 0
+COURSE_MESSAGE = 31
+LAP_MESSAGE = 19
+EVENT_MESSAGE = 21
+RECORD_MESSAGE = 20
+
+# ISO 8601 date and time, as in GPX and TCX. datetime.fromisoformat is not
+# available before Python 3.7 and does not take a "Z" suffix.
+_TIME = re.compile(
+    r"^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(\.\d+)?"
+    r"(Z|[+-]\d{2}:?\d{2})?$"
+)
+
+# Bumped when the encoding changes, to invalidate the cache
+_ENCODER_VERSION = 1
+
+# The earliest absolute FIT date_time, smaller values are relative times
+_MIN_DATE_TIME = 0x10000000
+
+_EARTH_RADIUS = 6371008.8
+
+_CACHE_DIRECTORY = "course_cache"
+_IMPORTED_FILE = "imported.json"
+
+
+class CourseError(Exception):
+    def __init__(self, message):
+        super(CourseError, self).__init__(message)
+
+
+class Point:
+    def __init__(self, lat, lon, altitude=None, time=None):
+        self.lat = lat
+        self.lon = lon
+        self.altitude = altitude
+        self.time = time
+        self.distance = 0.0
+
+
+def _local_name(element):
+    return element.tag.rsplit("}", 1)[-1]
+
+
+def _children(element, name):
+    return [child for child in element.iter() if _local_name(child) == name]
+
+
+def _text(element, name):
+    for child in element:
+        if _local_name(child) == name and child.text:
+            return child.text.strip()
+    return None
+
+
+def _parse_time(value):
+    """Seconds since the Unix epoch of an ISO 8601 time, or None"""
+    match = _TIME.match(value.strip()) if value is not None else None
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    try:
+        time = datetime.datetime(
+            int(year), int(month), int(day), int(hour), int(minute), int(second)
+        )
+    except ValueError:
+        return None
+    seconds = calendar.timegm(time.timetuple()) + float(fraction or 0)
+    if zone is not None and zone != "Z":
+        offset = int(zone[1:3]) * 3600 + int(zone[-2:]) * 60
+        seconds -= offset if zone[0] == "+" else -offset
+    return seconds
+
+
+def _float(value):
+    """An optional number, None if missing or not a number"""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+
+def _coordinate(value, limit):
+    try:
+        degrees = float(value)
+    except (TypeError, ValueError):
+        raise CourseError("Invalid coordinate {0!r}".format(value))
+    if not -limit <= degrees <= limit:
+        raise CourseError("Invalid coordinate {0!r}".format(value))
+    return degrees
+
+
+def parse(data):
+    """Return the name and points of a GPX or TCX route or track"""
+    try:
+        root = ElementTree.fromstring(data)
+    except ElementTree.ParseError as e:
+        raise CourseError("Not a GPX or TCX file: {0}".format(e))
+    points = []
+    name = None
+    if _local_name(root) == "gpx":
+        for element in _children(root, "trkpt") or _children(root, "rtept"):
+            points.append(
+                Point(
+                    _coordinate(element.get("lat"), 90),
+                    _coordinate(element.get("lon"), 180),
+                    _float(_text(element, "ele")),
+                    _parse_time(_text(element, "time")),
+                )
+            )
+        for parent in _children(root, "trk") + _children(root, "rte"):
+            name = name or _text(parent, "name")
+    elif _local_name(root) == "TrainingCenterDatabase":
+        for element in _children(root, "Trackpoint"):
+            position = next(iter(_children(element, "Position")), None)
+            if position is None:
+                continue
+            points.append(
+                Point(
+                    _coordinate(_text(position, "LatitudeDegrees"), 90),
+                    _coordinate(_text(position, "LongitudeDegrees"), 180),
+                    _float(_text(element, "AltitudeMeters")),
+                    _parse_time(_text(element, "Time")),
+                )
+            )
+        for parent in _children(root, "Course"):
+            name = name or _text(parent, "Name")
+    else:
+        raise CourseError("Not a GPX or TCX file")
+    if len(points) < 2:
+        raise CourseError("The route has less than two points")
+    return name, points
+
+
+def _distance(a, b):
+    """Great circle distance in meters"""
+    lat1, lat2 = math.radians(a.lat), math.radians(b.lat)
+    dlat = lat2 - lat1
+    dlon = math.radians(b.lon - a.lon)
+    h = math.sin(dlat / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * (
+        math.sin(dlon / 2) ** 2
+    )
+    return 2 * _EARTH_RADIUS * math.asin(min(1.0, math.sqrt(h)))
+
+
+def simplify(points, tolerance):
+    """Ramer-Douglas-Peucker, keep the points further than tolerance meters
+    from the line between the points kept around them"""
+    if len(points) < 3 or tolerance <= 0:
+        return list(points)
+    # Project to a plane, good enough for the short distances compared
+    lat0 = math.radians(sum(p.lat for p in points) / len(points))
+    scale = math.pi / 180 * _EARTH_RADIUS
+    xy = [(p.lon * scale * math.cos(lat0), p.lat * scale) for p in points]
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (x1, y1), (x2, y2) = xy[first], xy[last]
+        dx, dy = x2 - x1, y2 - y1
+        length = math.hypot(dx, dy)
+        farthest, index = 0.0, None
+        for i in range(first + 1, last):
+            x, y = xy[i]
+            if length == 0:
+                d = math.hypot(x - x1, y - y1)
+            else:
+                d = abs(dy * (x - x1) - dx * (y - y1)) / length
+            if d > farthest:
+                farthest, index = d, i
+        if index is not None and farthest > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [p for p, k in zip(points, keep) if k]
+
+
+def _semicircles(degrees):
+    return int(round(degrees * (2**31 / 180.0)))
+
+
+def encode(name, points, tolerance=5.0, speed=15.0):
+    """Encode a course FIT file
+
+    Distances are measured along all points, before simplifying. If a
+    point has no time, or the times go backwards, all points are given one
+    from speed (km/h).
+    """
+    for previous, point in zip(points, points[1:]):
+        point.distance = previous.distance + _distance(previous, point)
+    points = simplify(points, tolerance)
+
+    timed = all(p.time is not None for p in points) and all(
+        a.time <= b.time for a, b in zip(points, points[1:])
+    )
+    start = (
+        int(points[0].time) - fit.EPOCH_OFFSET
+        if timed and points[0].time - fit.EPOCH_OFFSET >= _MIN_DATE_TIME
+        else _MIN_DATE_TIME
+    )
+    times = [
+        (
+            start + int(round(p.time - points[0].time))
+            if timed
+            else start + int(round(p.distance / (speed / 3.6)))
+        )
+        for p in points
+    ]
+    end = times[-1]
+    first, last = points[0], points[-1]
+
+    encoder = fit.Encoder()
+    encoder.message(
+        FILE_ID_MESSAGE,
+        [
+            (0, 0x00, 6),  # type: course
+            (1, 0x84, 255),  # manufacturer: development
+            (2, 0x84, 0),  # product
+            (4, 0x86, start),  # time_created
+        ],
+    )
+    encoder.message(COURSE_MESSAGE, [(5, 0x07, (name or "Course")[:15])])
+    encoder.message(
+        LAP_MESSAGE,
+        [
+            (253, 0x86, start),
+            (2, 0x86, start),  # start_time
+            (3, 0x85, _semicircles(first.lat)),
+            (4, 0x85, _semicircles(first.lon)),
+            (5, 0x85, _semicircles(last.lat)),
+            (6, 0x85, _semicircles(last.lon)),
+            (7, 0x86, (end - start) * 1000),  # total_elapsed_time
+            (8, 0x86, (end - start) * 1000),  # total_timer_time
+            (9, 0x86, int(round(last.distance * 100))),  # total_distance
+        ],
+    )
+    # Timer start
+    encoder.message(EVENT_MESSAGE, [(253, 0x86, start), (0, 0x00, 0), (1, 0x00, 0)])
+    for point, time in zip(points, times):
+        fields = [
+            (253, 0x86, time),
+            (0, 0x85, _semicircles(point.lat)),
+            (1, 0x85, _semicircles(point.lon)),
+            (5, 0x86, int(round(point.distance * 100))),
+        ]
+        if point.altitude is not None:
+            altitude = int(round((point.altitude + 500) * 5))
+            fields.append((2, 0x84, min(max(altitude, 0), 0xFFFE)))
+        encoder.message(RECORD_MESSAGE, fields)
+    # Timer stop_disable_all
+    encoder.message(EVENT_MESSAGE, [(253, 0x86, end), (0, 0x00, 0), (1, 0x00, 9)])
+    return encoder.get_data()
+
+
+class Compiler:
+    """Compiles GPX and TCX routes to FIT courses, with a cache
+
+    Compiled courses are kept in <config>/course_cache by a hash of the
+    source and the options, so unchanged routes are not encoded again.
+    """
+
+    def __init__(self, config_dir, tolerance=5.0, speed=15.0):
+        self._config_dir = config_dir
+        self._directory = os.path.join(config_dir, _CACHE_DIRECTORY)
+        self._tolerance = tolerance
+        self._speed = speed
+
+    def get_key(self, data, name=None):
+        digest = hashlib.sha256(data)
+        digest.update(
+            json.dumps([_ENCODER_VERSION, self._tolerance, self._speed, name]).encode(
+                "utf-8"
+            )
+        )
+        return digest.hexdigest()
+
+    def compile(self, data, name=None):
+        """Return (key, FIT data, True if taken from the cache)"""
+        key = self.get_key(data, name)
+        path = os.path.join(self._directory, key + ".fit")
+        try:
+            with open(path, "rb") as f:
+                return key, f.read(), True
+        except IOError:
+            pass
+        route_name, points = parse(data)
+        result = encode(name or route_name, points, self._tolerance, self._speed)
+        utilities.makedirs_if_not_exists(self._directory)
+        with open(path + ".tmp", "wb") as f:
+            f.write(result)
+        os.replace(path + ".tmp", path)
+        return key, result, False
+
+    def _load_imported(self):
+        try:
+            with open(os.path.join(self._directory, _IMPORTED_FILE)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def add(self, serial, filename, name=None, force=False):
+        """Compile a route into the courses folder of a device, to be sent
+        with --upload. Returns the stored path, or None if the same course
+        was added to the device before (unless force is set)."""
+        path = os.path.join(self._config_dir, str(serial))
+        if not os.path.isdir(path):
+            raise CourseError("No such device {0}".format(serial))
+        with open(filename, "rb") as f:
+            data = f.read()
+        key, result, _ = self.compile(data, name)
+
+        imported = self._load_imported()
+        keys = imported.setdefault(str(serial), [])
+        if key in keys and not force:
+            return None
+        store = storage.Storage(path, layout=archive.get_layout(path))
+        stem = os.path.splitext(os.path.basename(filename))[0]
+        folder = archive._filetypes[archive.FileType.COURSE]
+        stored = store.write(folder, stem + ".fit", result)
+        index.Index(self._config_dir).add(serial, folder, stem + ".fit")
+        if key not in keys:
+            keys.append(key)
+        imported_path = os.path.join(self._directory, _IMPORTED_FILE)
+        with open(imported_path + ".tmp", "w") as f:
+            json.dump(imported, f)
+        os.replace(imported_path + ".tmp", imported_path)
+        return stored
@@ -0,0 +1,166 @@
+# Dedup
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import errno
+import filecmp
+import hashlib
+import json
+import logging
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from . import archive
+from . import storage
+from . import utilities
+
+_logger = logging.getLogger()
+
+_CACHE_FILE = "dedup.json"
+
+# ioctl cloning a whole file on Linux (btrfs, xfs and others), _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+
+METHODS = ["hardlink", "reflink"]
+
+
+class HashCache:
+    """SHA-256 of files by device and inode, valid while mtime and size are
+    unchanged"""
+
+    def __init__(self, path):
+        self._path = path
+        try:
+            with open(path, "r") as f:
+                self._entries = json.load(f)
+        except (IOError, ValueError):
+            self._entries = {}
+        self._used = set()
+
+    def get(self, filename, stat):
+        key = "{0}:{1}".format(stat.st_dev, stat.st_ino)
+        self._used.add(key)
+        entry = self._entries.get(key)
+        if entry is not None and entry[:2] == [stat.st_mtime_ns, stat.st_size]:
+            return entry[2]
+        digest = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(storage.FRAME_SIZE), b""):
+                digest.update(chunk)
+        self._entries[key] = [stat.st_mtime_ns, stat.st_size, digest.hexdigest()]
+        return self._entries[key][2]
+
+    def save(self):
+        # Forget inodes no longer in the archive, they may be reused
+        entries = dict((k, v) for (k, v) in self._entries.items() if k in self._used)
+        utilities.makedirs_if_not_exists(os.path.dirname(self._path))
+        with open(self._path + ".tmp", "w") as f:
+            json.dump(entries, f)
+        os.replace(self._path + ".tmp", self._path)
+
+
+def _reflink(src, dst):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported")
+    with open(src, "rb") as source, open(dst, "wb") as target:
+        fcntl.ioctl(target.fileno(), _FICLONE, source.fileno())
+
+
+def _replace(original, duplicate, method):
+    """Replace duplicate by a hardlink or reflink of original, atomically"""
+    temporary = duplicate + ".dedup"
+    try:
+        if method == "reflink":
+            _reflink(original, temporary)
+            stat = os.stat(duplicate)
+            os.utime(temporary, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        else:
+            os.link(original, temporary)
+        os.replace(temporary, duplicate)
+    except OSError:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def dedup(config_dir, serials=None, method="hardlink", dry_run=False, callback=None):
+    """Replace identical stored files by links to one copy
+
+    Files are compared by size, then by a cached hash and finally byte by
+    byte. Files are never written in place (see storage.Storage.write), so
+    linked copies stay independent when one is replaced. Files on different
+    file systems are left alone. callback(duplicate, original) is called for
+    every file replaced. Returns the number of files and bytes saved.
+    """
+    if method not in METHODS:
+        raise ValueError("Unknown method {0}".format(method))
+    cache = HashCache(os.path.join(config_dir, _CACHE_FILE))
+    by_size = {}
+    for serial in serials or archive.get_devices(config_dir):
+        path = os.path.join(config_dir, str(serial))
+        store = storage.Storage(path, layout=archive.get_layout(path))
+        for folder in archive._directories:
+            for name in store.list(folder):
+                filename = store.get_path(folder, name)
+                stat = os.stat(filename)
+                by_size.setdefault(stat.st_size, []).append((filename, stat))
+
+    files = 0
+    saved = 0
+    for size, candidates in sorted(by_size.items()):
+        if len(candidates) < 2 or size == 0:
+            continue
+        by_hash = {}
+        for filename, stat in sorted(candidates):
+            by_hash.setdefault(cache.get(filename, stat), []).append((filename, stat))
+        for same in by_hash.values():
+            original, first = same[0]
+            for duplicate, stat in same[1:]:
+                if (stat.st_dev, stat.st_ino) == (first.st_dev, first.st_ino):
+                    continue
+                if stat.st_dev != first.st_dev:
+                    continue
+                if not filecmp.cmp(original, duplicate, shallow=False):
+                    continue
+                if not dry_run:
+                    try:
+                        _replace(original, duplicate, method)
+                    except OSError as e:
+                        if e.errno not in (
+                            errno.EOPNOTSUPP,
+                            errno.ENOTTY,
+                            errno.EXDEV,
+                            errno.EINVAL,
+                        ):
+                            raise
+                        _logger.warning("Could not %s %s: %s", method, duplicate, e)
+                        continue
+                files += 1
+                saved += size
+                if callback is not None:
+                    callback(duplicate, original)
+    cache.save()
+    return files, saved
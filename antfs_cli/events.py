@@ -0,0 +1,125 @@
+# Events
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import datetime
+import errno
+import json
+import os
+import sys
+import threading
+import time
+
+
+class TextEvents:
+    """Human readable output, one handler per event"""
+
+    def __init__(self, stream=None):
+        self._stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        handler = getattr(self, "_on_" + event, None)
+        if handler is not None:
+            with self._lock:
+                handler(**fields)
+                self._stream.flush()
+
+    def _write(self, *args, end="\n"):
+        self._stream.write(" ".join(str(arg) for arg in args) + end)
+
+    def _on_search(self, serial=None):
+        if serial is None:
+            self._write("Searching...")
+        else:
+            self._write("Searching for {0}...".format(serial))
+
+    def _on_link(self, latency=None, targeted=None, **fields):
+        if latency is not None:
+            self._write(" - Found after {0:.1f} s".format(latency))
+
+    def _on_authenticate(self, name, serial):
+        self._write("Authenticating with", name, "(" + str(serial) + ")")
+
+    def _on_auth_start(self, method):
+        self._write(" - {0}:".format(method.capitalize()), end=" ")
+
+    def _on_auth_result(self, method, ok):
+        self._write("OK" if ok else "FAILED")
+
+    def _on_set_time(self, ok):
+        self._write(" - Set time:", "OK" if ok else "FAILED")
+
+    def _on_directory(self, downloading, uploading=None, **fields):
+        self._write("Downloading", downloading, "file(s)")
+        if uploading is not None:
+            self._write(" and uploading", uploading, "file(s)")
+
+    def _on_file_start(self, action, name, **fields):
+        self._write("{0} {1}:".format(action.capitalize() + "ing", name), end=" ")
+
+    def _on_progress(self, progress, elapsed, **fields):
+        s = "[{0:<30}]".format("." * int(progress * 30))
+        if progress == 0:
+            s += " started"
+        else:
+            eta = datetime.timedelta(seconds=int(elapsed / progress - elapsed))
+            s += " ETA: {0}".format(eta)
+        self._write(s + "\b" * len(s), end="")
+
+    def _on_file_done(self, **fields):
+        self._write("")
+
+    def _on_stored(self, name, error=None, **fields):
+        if error is not None:
+            self._write(" - {0}: {1}".format(name, error))
+
+    def _on_rename(self, src, dst):
+        self._write(" - Renamed", src, "to", dst)
+
+    def _on_rename_failed(self, index, name, error):
+        self._write(" - Failed", index, name, error)
+
+    def _on_script(self, script, error=None, **fields):
+        if error is not None:
+            self._write(
+                " - Could not run",
+                script,
+                "-",
+                errno.errorcode[error],
+                os.strerror(error),
+            )
+
+
+class JsonEvents:
+    """Newline delimited JSON, one object per event"""
+
+    def __init__(self, stream=None):
+        self._stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        fields["event"] = event
+        fields["time"] = time.time()
+        line = json.dumps(fields, sort_keys=True, default=str)
+        with self._lock:
+            self._stream.write(line + "\n")
+            self._stream.flush()
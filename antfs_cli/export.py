@@ -0,0 +1,265 @@
+# Export
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import array
+import ast
+import json
+import logging
+import os
+import struct
+import sys
+import zipfile
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from . import archive
+from . import fit
+from . import storage
+from . import utilities
+
+_logger = logging.getLogger()
+
+RECORD_MESSAGE = 20
+
+# Columns of the record message: name, field number, array typecode, scale,
+# offset and invalid value. Values are stored as in the FIT file, the real
+# value is stored / scale - offset. Missing values are stored as invalid.
+# The timestamp is converted to seconds since the Unix epoch.
+RECORD_COLUMNS = [
+    ("timestamp", fit.TIMESTAMP_FIELD, "I", 1, 0, 0),
+    ("position_lat", 0, "i", 1, 0, 0x7FFFFFFF),
+    ("position_long", 1, "i", 1, 0, 0x7FFFFFFF),
+    ("altitude", 2, "H", 5, 500, 0xFFFF),
+    ("heart_rate", 3, "B", 1, 0, 0xFF),
+    ("cadence", 4, "B", 1, 0, 0xFF),
+    ("distance", 5, "I", 100, 0, 0xFFFFFFFF),
+    ("speed", 6, "H", 1000, 0, 0xFFFF),
+    ("power", 7, "H", 1, 0, 0xFFFF),
+    ("temperature", 13, "b", 1, 0, 0x7F),
+]
+
+_NUMPY_TYPES = {
+    "b": "|i1",
+    "B": "|u1",
+    "h": "<i2",
+    "H": "<u2",
+    "i": "<i4",
+    "I": "<u4",
+    "q": "<i8",
+    "d": "<f8",
+}
+
+_ARROW_TYPES = {
+    "b": "int8",
+    "B": "uint8",
+    "h": "int16",
+    "H": "uint16",
+    "i": "int32",
+    "I": "uint32",
+    "q": "int64",
+    "d": "float64",
+}
+
+_FORMATS = {"npz": ".npz", "parquet": ".parquet"}
+
+
+class ExportError(Exception):
+    def __init__(self, message):
+        super(ExportError, self).__init__(message)
+
+
+def _new_array(typecode):
+    # array's "i" and "I" are not four bytes on every platform
+    column = array.array(typecode)
+    if column.itemsize != struct.calcsize(typecode):
+        raise ExportError("Unsupported platform for typecode " + typecode)
+    return column
+
+
+def decode_records(fd):
+    """Decode the record messages of a FIT file into typed columns"""
+    columns = dict((name, _new_array(t)) for name, _, t, _, _, _ in RECORD_COLUMNS)
+    appenders = [
+        (columns[name].append, number, invalid)
+        for name, number, _, _, _, invalid in RECORD_COLUMNS
+    ]
+    for _, message in fit.read_messages(fd, [RECORD_MESSAGE]):
+        timestamp = message.get(fit.TIMESTAMP_FIELD)
+        if timestamp is None:
+            continue
+        message[fit.TIMESTAMP_FIELD] = timestamp + fit.EPOCH_OFFSET
+        for append, number, invalid in appenders:
+            value = message.get(number)
+            append(invalid if value is None or isinstance(value, tuple) else value)
+    return columns
+
+
+def _npy(column):
+    """A column as a .npy file"""
+    header = "{{'descr': '{0}', 'fortran_order': False, 'shape': ({1},), }}".format(
+        _NUMPY_TYPES[column.typecode], len(column)
+    )
+    # Magic, version, header length and header padded to 64 bytes
+    header += " " * (63 - (10 + len(header)) % 64) + "\n"
+    if sys.byteorder == "big":
+        column = array.array(column.typecode, column)
+        column.byteswap()
+    return (
+        b"\x93NUMPY\x01\x00"
+        + struct.pack("<H", len(header))
+        + header.encode("latin1")
+        + column.tobytes()
+    )
+
+
+def write_npz(path, columns):
+    with zipfile.ZipFile(path + ".tmp", "w", zipfile.ZIP_STORED) as f:
+        for name, column in columns.items():
+            f.writestr(name + ".npy", _npy(column))
+    os.replace(path + ".tmp", path)
+
+
+def read_npz(path):
+    """Read a .npz file written by write_npz into arrays, without numpy"""
+    typecodes = dict((v, k) for (k, v) in _NUMPY_TYPES.items())
+    columns = {}
+    with zipfile.ZipFile(path) as f:
+        for filename in f.namelist():
+            data = f.read(filename)
+            (length,) = struct.unpack_from("<H", data, 8)
+            header = ast.literal_eval(data[10 : 10 + length].decode("latin1"))
+            column = array.array(typecodes[header["descr"]])
+            column.frombytes(data[10 + length :])
+            if sys.byteorder == "big":
+                column.byteswap()
+            columns[filename[:-4]] = column
+    return columns
+
+
+def write_parquet(path, columns):
+    if pyarrow is None:
+        raise ExportError("Parquet export requires the pyarrow module")
+    table = pyarrow.table(
+        dict(
+            (name, pyarrow.array(column, type=_ARROW_TYPES[column.typecode]))
+            for name, column in columns.items()
+        )
+    )
+    pyarrow.parquet.write_table(table, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+class Exporter:
+    """Keeps a columnar copy of the records of all activities
+
+    Each activity is a partition, <export dir>/<serial>/<name>.npz (or
+    .parquet), next to a schema.json describing the columns. A partition is
+    only written again if its FIT file is newer.
+    """
+
+    def __init__(self, config_dir, directory=None, format="npz"):
+        if format not in _FORMATS:
+            raise ExportError("Unknown format {0}".format(format))
+        if format == "parquet" and pyarrow is None:
+            raise ExportError("Parquet export requires the pyarrow module")
+        self._config_dir = config_dir
+        self._directory = directory or os.path.join(config_dir, "export")
+        self._format = format
+
+    def get_directory(self):
+        return self._directory
+
+    def _write_schema(self):
+        path = os.path.join(self._directory, "schema.json")
+        if os.path.exists(path):
+            return
+        schema = [
+            {
+                "name": name,
+                "type": _NUMPY_TYPES[typecode],
+                "scale": scale,
+                "offset": offset,
+                "invalid": invalid,
+            }
+            for name, _, typecode, scale, offset, invalid in RECORD_COLUMNS
+        ]
+        with open(path, "w") as f:
+            json.dump(schema, f, indent=2)
+
+    def get_partition(self, serial, name):
+        return os.path.join(
+            self._directory,
+            str(serial),
+            os.path.splitext(name)[0] + _FORMATS[self._format],
+        )
+
+    def export(self, store, serial, name):
+        """Export one activity if needed, return the partition or None"""
+        partition = self.get_partition(serial, name)
+        source = store.get_path("activities", name)
+        if os.path.exists(partition) and os.path.getmtime(
+            partition
+        ) >= os.path.getmtime(source):
+            return None
+        try:
+            with store.open("activities", name) as fd:
+                columns = decode_records(fd)
+        except (fit.FitError, struct.error, IndexError, OverflowError) as e:
+            _logger.warning("Could not export %s: %s", source, e)
+            return None
+
+        utilities.makedirs_if_not_exists(os.path.dirname(partition))
+        self._write_schema()
+        if self._format == "parquet":
+            write_parquet(partition, columns)
+        else:
+            write_npz(partition, columns)
+        return partition
+
+    def update(self, serials=None):
+        """Export all new or changed activities, return the partitions"""
+        partitions = []
+        for serial in serials or archive.get_devices(self._config_dir):
+            path = os.path.join(self._config_dir, str(serial))
+            store = storage.Storage(path, layout=archive.get_layout(path))
+            for name in sorted(store.list("activities")):
+                partition = self.export(store, serial, name)
+                if partition is not None:
+                    partitions.append(partition)
+        return partitions
+
+    def on_action(self, action, filename, fit_type):
+        """scripting.Runner hook, exports activities as they are downloaded"""
+        if action != "DOWNLOAD" or fit_type != archive.FileType.ACTIVITY:
+            return
+        serial = archive.get_serial(
+            filename, archive._filetypes[archive.FileType.ACTIVITY]
+        )
+        if serial is None:
+            return
+        path = os.path.join(self._config_dir, serial)
+        store = storage.Storage(path, layout=archive.get_layout(path))
+        self.export(store, serial, os.path.basename(filename))
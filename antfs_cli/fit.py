@@ -0,0 +1,313 @@
+# FIT
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import struct
+
+
+class FitError(Exception):
+    def __init__(self, message):
+        super(FitError, self).__init__(message)
+
+
+def _make_crc_table():
+    # The FIT CRC (CRC-16, polynomial 0xA001 reflected), one byte at a time
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC_TABLE = _make_crc_table()
+
+_HEADER = struct.Struct("<BBHI4s")
+
+
+def crc(data, value=0):
+    table = _CRC_TABLE
+    for byte in data:
+        value = (value >> 8) ^ table[(value ^ byte) & 0xFF]
+    return value
+
+
+class Header:
+    def __init__(self, size, protocol_version, profile_version, data_size):
+        self.size = size
+        self.protocol_version = protocol_version
+        self.profile_version = profile_version
+        self.data_size = data_size
+
+    @staticmethod
+    def parse(data):
+        if len(data) < _HEADER.size:
+            raise FitError("Truncated header")
+        size, protocol, profile, data_size, signature = _HEADER.unpack_from(data)
+        if signature != b".FIT" or size not in (12, 14):
+            raise FitError("Not a FIT file")
+        if len(data) < size:
+            raise FitError("Truncated header")
+        if size == 14:
+            (header_crc,) = struct.unpack_from("<H", data, 12)
+            if header_crc != 0 and header_crc != crc(data[:12]):
+                raise FitError("Header CRC mismatch")
+        return Header(size, protocol, profile, data_size)
+
+
+def check(fd, chunk_size=64 * 1024):
+    """Check the header and CRC of a FIT file, raise FitError if bad
+
+    The file may hold several FIT files after each other, each is checked.
+    Returns the headers.
+    """
+    headers = []
+    while True:
+        first = fd.read(1)
+        if not first:
+            if headers:
+                return headers
+            raise FitError("Empty file")
+        data = first + fd.read(max(first[0], _HEADER.size) - 1)
+        header = Header.parse(data)
+        headers.append(header)
+
+        value = crc(data)
+        remaining = header.data_size
+        while remaining > 0:
+            chunk = fd.read(min(chunk_size, remaining))
+            if not chunk:
+                raise FitError("Truncated data")
+            value = crc(chunk, value)
+            remaining -= len(chunk)
+        trailer = fd.read(2)
+        if len(trailer) != 2:
+            raise FitError("Truncated CRC")
+        if struct.unpack("<H", trailer)[0] != value:
+            raise FitError("CRC mismatch")
+
+
+# Base type -> (struct format, invalid value), looked up by the base type
+# number (the low five bits)
+_BASE_TYPES = {
+    0x00: ("B", 0xFF),  # enum
+    0x01: ("b", 0x7F),  # sint8
+    0x02: ("B", 0xFF),  # uint8
+    0x83: ("h", 0x7FFF),  # sint16
+    0x84: ("H", 0xFFFF),  # uint16
+    0x85: ("i", 0x7FFFFFFF),  # sint32
+    0x86: ("I", 0xFFFFFFFF),  # uint32
+    0x07: ("s", None),  # string
+    0x88: ("f", None),  # float32
+    0x89: ("d", None),  # float64
+    0x0A: ("B", 0x00),  # uint8z
+    0x8B: ("H", 0x0000),  # uint16z
+    0x8C: ("I", 0x00000000),  # uint32z
+    0x0D: ("B", 0xFF),  # byte
+    0x8E: ("q", 0x7FFFFFFFFFFFFFFF),  # sint64
+    0x8F: ("Q", 0xFFFFFFFFFFFFFFFF),  # uint64
+    0x90: ("Q", 0x0000000000000000),  # uint64z
+}
+_BASE_TYPES = dict((k & 0x1F, v) for (k, v) in _BASE_TYPES.items())
+
+# Seconds between the Unix epoch and the FIT epoch (1989-12-31 00:00 UTC)
+EPOCH_OFFSET = 631065600
+
+TIMESTAMP_FIELD = 253
+
+
+class _Definition:
+    """A definition message, compiled to a single struct"""
+
+    def __init__(self, global_number, endian, fields, developer_size):
+        self.global_number = global_number
+        # (field number, index in the unpacked values, count, invalid), count
+        # is 0 for strings and for fields that are kept as bytes
+        self.fields = []
+        self.has_timestamp = False
+        fmt = endian
+        index = 0
+        for number, size, base_type in fields:
+            code, invalid = _BASE_TYPES.get(base_type & 0x1F, ("s", None))
+            code_size = struct.calcsize("<" + code) if code != "s" else size
+            if code == "s" or size % code_size != 0:
+                fmt += "{0}s".format(size)
+                string = code == "s" and (base_type & 0x1F) == 0x07
+                self.fields.append((number, index, 0, string))
+                index += 1
+            else:
+                count = size // code_size
+                fmt += code * count
+                self.fields.append((number, index, count, invalid))
+                index += count
+            self.has_timestamp |= number == TIMESTAMP_FIELD
+        if developer_size:
+            fmt += "{0}x".format(developer_size)
+        self.struct = struct.Struct(fmt)
+
+    def decode(self, data, offset):
+        values = self.struct.unpack_from(data, offset)
+        message = {}
+        for number, index, count, invalid in self.fields:
+            if count == 0:
+                value = values[index]
+                if invalid:
+                    value = value.split(b"\0", 1)[0].decode("utf-8", "replace")
+            elif count == 1:
+                value = values[index]
+                if value == invalid:
+                    value = None
+            else:
+                value = tuple(
+                    v if v != invalid else None for v in values[index : index + count]
+                )
+            message[number] = value
+        return message
+
+
+def read_messages(fd, messages=None):
+    """Yield (global message number, {field number: value}) from a FIT file
+
+    Invalid values are None, strings are decoded and array fields are
+    tuples. If messages is given only those global message numbers are
+    decoded, others are skipped. The header is checked but not the CRC, see
+    check.
+    """
+    data = fd.read()
+    offset = 0
+    while offset < len(data):
+        header = Header.parse(data[offset : offset + 14])
+        end = offset + header.size + header.data_size
+        if end > len(data):
+            raise FitError("Truncated data")
+        offset += header.size
+        definitions = {}
+        timestamp = 0
+        while offset < end:
+            record = data[offset]
+            offset += 1
+            if record & 0x80:
+                # Compressed timestamp header
+                local = (record >> 5) & 0x03
+                time_offset = record & 0x1F
+                timestamp += (time_offset - timestamp) & 0x1F
+                definition = definitions.get(local)
+                if definition is None:
+                    raise FitError("Undefined local message {0}".format(local))
+                if messages is None or definition.global_number in messages:
+                    message = definition.decode(data, offset)
+                    message[TIMESTAMP_FIELD] = timestamp
+                    yield definition.global_number, message
+                offset += definition.struct.size
+            elif record & 0x40:
+                # Definition message
+                local = record & 0x0F
+                endian = "<" if data[offset + 1] == 0 else ">"
+                (global_number,) = struct.unpack_from(endian + "H", data, offset + 2)
+                count = data[offset + 4]
+                offset += 5
+                fields = [
+                    tuple(data[offset + i * 3 : offset + i * 3 + 3])
+                    for i in range(count)
+                ]
+                offset += count * 3
+                developer_size = 0
+                if record & 0x20:
+                    developer_count = data[offset]
+                    offset += 1
+                    developer_size = sum(
+                        data[offset + i * 3 + 1] for i in range(developer_count)
+                    )
+                    offset += developer_count * 3
+                definitions[local] = _Definition(
+                    global_number, endian, fields, developer_size
+                )
+            else:
+                local = record & 0x0F
+                definition = definitions.get(local)
+                if definition is None:
+                    raise FitError("Undefined local message {0}".format(local))
+                if messages is None or definition.global_number in messages:
+                    message = definition.decode(data, offset)
+                    if message.get(TIMESTAMP_FIELD) is not None:
+                        timestamp = message[TIMESTAMP_FIELD]
+                    yield definition.global_number, message
+                elif definition.has_timestamp:
+                    message = definition.decode(data, offset)
+                    if message.get(TIMESTAMP_FIELD) is not None:
+                        timestamp = message[TIMESTAMP_FIELD]
+                offset += definition.struct.size
+        offset = end + 2
+
+
+class Encoder:
+    """Builds a FIT file a message at a time
+
+    Fields are given as (field number, base type, value), with the base
+    type as in a definition message (e.g. 0x86 for uint32). Strings are
+    given as str and stored null terminated. A definition is written
+    whenever the fields of a message differ from the last one using the
+    same local message number.
+    """
+
+    _LOCAL_MESSAGES = 16
+    PROFILE_VERSION = 2014
+
+    def __init__(self):
+        self._data = bytearray()
+        self._locals = {}
+        self._next = 0
+
+    def message(self, global_number, fields):
+        values = []
+        layout = []
+        fmt = "<B"
+        for number, base_type, value in fields:
+            code, _ = _BASE_TYPES[base_type & 0x1F]
+            if code == "s":
+                value = value.encode("utf-8") + b"\0"
+                size = len(value)
+                fmt += "{0}s".format(size)
+            else:
+                size = struct.calcsize("<" + code)
+                fmt += code
+            layout.append((number, size, base_type))
+            values.append(value)
+        key = (global_number, tuple(layout))
+
+        local = self._locals.get(key)
+        if local is None:
+            local = self._next % self._LOCAL_MESSAGES
+            self._next += 1
+            self._locals = dict((k, v) for (k, v) in self._locals.items() if v != local)
+            self._locals[key] = local
+            self._data += struct.pack(
+                "<BBBHB", 0x40 | local, 0, 0, global_number, len(layout)
+            )
+            for field in layout:
+                self._data += struct.pack("<BBB", *field)
+        self._data += struct.pack(fmt, local, *values)
+
+    def get_data(self):
+        header = _HEADER.pack(14, 0x10, self.PROFILE_VERSION, len(self._data), b".FIT")
+        header += struct.pack("<H", crc(header))
+        return header + bytes(self._data) + struct.pack("<H", crc(header + self._data))
@@ -0,0 +1,139 @@
+# Fsck
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import concurrent.futures
+import json
+import logging
+import os
+
+from . import archive
+from . import fit
+from . import index
+from . import storage
+
+_logger = logging.getLogger()
+
+_CACHE_FILE = "fsck.json"
+
+# Suffix given to bad files, which hides them from the local scan so that
+# they are downloaded again on the next sync
+CORRUPT_SUFFIX = ".corrupt"
+
+
+def get_corrupt_path(filename):
+    """Where a bad stored file is kept, its name with CORRUPT_SUFFIX after
+    any compression suffix"""
+    return filename + CORRUPT_SUFFIX
+
+
+def check_file(path, folder, name):
+    """Check one stored file, return None if good or the error"""
+    try:
+        with storage.Storage(path).open(folder, name) as fd:
+            fit.check(fd)
+    except Exception as e:
+        # Damaged compressed files fail in the codec (zlib.error,
+        # zstandard.ZstdError, struct.error, ...), all are errors of the file
+        return str(e) or type(e).__name__
+    return None
+
+
+class Cache:
+    """Results of earlier checks, valid while mtime and size are unchanged"""
+
+    def __init__(self, path):
+        self._path = path
+        try:
+            with open(path, "r") as f:
+                self._entries = json.load(f)
+        except (IOError, ValueError):
+            self._entries = {}
+
+    def get(self, filename, stat):
+        entry = self._entries.get(filename)
+        if entry is not None and entry[:2] == [stat.st_mtime_ns, stat.st_size]:
+            return True, entry[2]
+        return False, None
+
+    def set(self, filename, stat, error):
+        self._entries[filename] = [stat.st_mtime_ns, stat.st_size, error]
+
+    def remove(self, filename):
+        self._entries.pop(filename, None)
+
+    def save(self):
+        with open(self._path + ".tmp", "w") as f:
+            json.dump(self._entries, f)
+        os.replace(self._path + ".tmp", self._path)
+
+
+def fsck(config_dir, serials=None, jobs=None, repair=True, callback=None):
+    """Check all FIT files of the given devices (default all)
+
+    Files are checked in a pool of jobs processes, files unchanged since the
+    last run are skipped. Bad files are renamed with CORRUPT_SUFFIX if
+    repair is set. callback(path, error) is called for every file once all
+    are checked, error is None for good files. Returns a list of (path,
+    error) for the bad files.
+    """
+    cache = Cache(os.path.join(config_dir, _CACHE_FILE))
+    results = []
+    pending = {}
+
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        for serial in serials or archive.get_devices(config_dir):
+            path = os.path.join(config_dir, str(serial))
+            store = storage.Storage(path, layout=archive.get_layout(path))
+            for folder in archive._directories:
+                for name in store.list(folder):
+                    filename = store.get_path(folder, name)
+                    stat = os.stat(filename)
+                    cached, error = cache.get(filename, stat)
+                    entry = (filename, serial, folder, name)
+                    if cached:
+                        results.append((entry, error))
+                        continue
+                    future = executor.submit(check_file, path, folder, name)
+                    pending[future] = (entry, stat)
+
+        for future in concurrent.futures.as_completed(pending):
+            entry, stat = pending[future]
+            error = future.result()
+            cache.set(entry[0], stat, error)
+            results.append((entry, error))
+
+    files = index.Index(config_dir)
+    bad = []
+    for (filename, serial, folder, name), error in sorted(results):
+        if callback is not None:
+            callback(filename, error)
+        if error is None:
+            continue
+        bad.append((filename, error))
+        _logger.warning("Bad file %s: %s", filename, error)
+        if repair:
+            os.rename(filename, get_corrupt_path(filename))
+            cache.remove(filename)
+            files.remove(int(serial), folder, name)
+
+    cache.save()
+    return bad
@@ -0,0 +1,197 @@
+# Index
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import contextlib
+import datetime
+import os
+import re
+import sqlite3
+import threading
+
+from . import archive
+from . import storage
+
+_INDEX_FILE = "index.sqlite"
+
+# Names given by program.get_filename, "YYYY-MM-DD_HH-MM-SS_<type>_<number>"
+_DATED_NAME = re.compile(r"^(\d{4}-\d{2}-\d{2})_(\d{2})-(\d{2})-(\d{2})_")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    serial INTEGER PRIMARY KEY,
+    profile_version INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    serial INTEGER NOT NULL,
+    folder TEXT NOT NULL,
+    name TEXT NOT NULL,
+    fit_type INTEGER NOT NULL,
+    date TEXT,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (serial, folder, name)
+);
+CREATE INDEX IF NOT EXISTS files_date ON files (date);
+CREATE INDEX IF NOT EXISTS files_type_date ON files (fit_type, date);
+"""
+
+
+def get_date(name):
+    """The date a file name starts with, as YYYY-MM-DD HH:MM:SS, or None"""
+    match = _DATED_NAME.match(name)
+    if match is None:
+        return None
+    return "{0} {1}:{2}:{3}".format(*match.groups())
+
+
+def next_day(day):
+    """The day after YYYY-MM-DD, to query files up to and including a day"""
+    return (
+        datetime.datetime.strptime(day, "%Y-%m-%d") + datetime.timedelta(days=1)
+    ).strftime("%Y-%m-%d")
+
+
+class Index:
+    """SQLite index of the stored files of all devices
+
+    A device is scanned the first time it is queried, and again if its
+    folder has been upgraded to a new profile version since. Downloaded and
+    renamed files are added as they are stored, see add and rename. Sizes
+    are of the stored, possibly compressed, files.
+    """
+
+    def __init__(self, config_dir):
+        self._config_dir = config_dir
+        self._path = os.path.join(config_dir, _INDEX_FILE)
+        self._lock = threading.Lock()
+
+    def get_path(self):
+        return self._path
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # A connection per call, so the index can be used from any thread
+        with self._lock, contextlib.closing(sqlite3.connect(self._path)) as db:
+            with db:
+                db.executescript(_SCHEMA)
+                yield db
+
+    def _get_storage(self, serial):
+        path = os.path.join(self._config_dir, str(serial))
+        return storage.Storage(path, layout=archive.get_layout(path))
+
+    def _scan(self, db, serial):
+        store = self._get_storage(serial)
+        db.execute("DELETE FROM files WHERE serial = ?", (serial,))
+        for folder, fit_type in archive._directories.items():
+            for name in store.list(folder):
+                size = os.path.getsize(store.get_path(folder, name))
+                db.execute(
+                    "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                    (serial, folder, name, fit_type, get_date(name), size),
+                )
+        version = archive.get_profile_version(
+            os.path.join(self._config_dir, str(serial))
+        )
+        db.execute("INSERT OR REPLACE INTO devices VALUES (?, ?)", (serial, version))
+
+    def update(self, serials=None, rescan=False):
+        """Scan devices not yet indexed, or all of them if rescan is set"""
+        serials = serials or archive.get_devices(self._config_dir)
+        with self._connect() as db:
+            versions = dict(db.execute("SELECT serial, profile_version FROM devices"))
+            for serial in serials:
+                version = archive.get_profile_version(
+                    os.path.join(self._config_dir, str(serial))
+                )
+                if rescan or versions.get(serial) != version:
+                    self._scan(db, serial)
+
+    def add(self, serial, folder, name):
+        """Add or update a stored file, if the device has been indexed"""
+        size = os.path.getsize(self._get_storage(serial).get_path(folder, name))
+        with self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO files SELECT ?, ?, ?, ?, ?, ? "
+                "WHERE EXISTS (SELECT 1 FROM devices WHERE serial = ?)",
+                (
+                    serial,
+                    folder,
+                    name,
+                    archive._directories[folder],
+                    get_date(name),
+                    size,
+                    serial,
+                ),
+            )
+
+    def remove(self, serial, folder, name):
+        with self._connect() as db:
+            db.execute(
+                "DELETE FROM files WHERE serial = ? AND folder = ? AND name = ?",
+                (serial, folder, name),
+            )
+
+    def rename(self, serial, folder, src, dst):
+        self.remove(serial, folder, src)
+        self.add(serial, folder, dst)
+
+    def query(
+        self,
+        serials=None,
+        fit_types=None,
+        start=None,
+        end=None,
+        min_size=None,
+        max_size=None,
+    ):
+        """Return (serial, folder, name, fit_type, date, size) of the
+        matching files, ordered by date
+
+        start and end are dates or date and times, "YYYY-MM-DD[ HH:MM:SS]",
+        start inclusive and end exclusive. Files without a date only match
+        if neither is given. Devices not yet indexed are scanned first.
+        """
+        self.update(serials)
+        conditions = []
+        parameters = []
+        for column, values in (("serial", serials), ("fit_type", fit_types)):
+            if values:
+                conditions.append(
+                    "{0} IN ({1})".format(column, ", ".join("?" * len(values)))
+                )
+                parameters.extend(values)
+        for condition, value in (
+            ("date >= ?", start),
+            ("date < ?", end),
+            ("size >= ?", min_size),
+            ("size <= ?", max_size),
+        ):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        sql = "SELECT serial, folder, name, fit_type, date, size FROM files"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY date, serial, folder, name"
+        with self._connect() as db:
+            return db.execute(sql, parameters).fetchall()
@@ -0,0 +1,183 @@
+# Migration
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import json
+import logging
+import os
+
+_logger = logging.getLogger()
+
+_JOURNAL_FILE = "migration.journal"
+
+# Version -> (description, function) upgrading from version to version + 1
+_migrations = {}
+
+
+class MigrationError(Exception):
+    def __init__(self, message):
+        super(MigrationError, self).__init__(message)
+
+
+def migration(version, description):
+    """Register a function(transaction, path) upgrading a device folder
+    from version to version + 1"""
+
+    def register(function):
+        _migrations[version] = (description, function)
+        return function
+
+    return register
+
+
+class Transaction:
+    """Filesystem changes of one migration step, which can be rolled back
+
+    Every change is appended to a journal in the device folder before it is
+    made, so that an interrupted step can be rolled back the next time the
+    device is opened. In dry run mode changes are only recorded.
+    """
+
+    def __init__(self, path, dry_run=False):
+        self._path = path
+        self._journal = os.path.join(path, _JOURNAL_FILE)
+        self._dry_run = dry_run
+        self._operations = []
+
+    def get_operations(self):
+        return self._operations
+
+    def _log(self, operation):
+        self._operations.append(operation)
+        if self._dry_run:
+            return False
+        with open(self._journal, "a") as f:
+            f.write(json.dumps(operation) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        return True
+
+    def makedirs(self, path):
+        if not os.path.isdir(path) and self._log({"op": "makedirs", "path": path}):
+            os.makedirs(path)
+
+    def rename(self, src, dst):
+        if os.path.exists(dst):
+            raise MigrationError("{0} already exists".format(dst))
+        if self._log({"op": "rename", "src": src, "dst": dst}):
+            os.rename(src, dst)
+
+    def write(self, path, data):
+        backup = path + ".bak" if os.path.exists(path) else None
+        if self._log({"op": "write", "path": path, "backup": backup}):
+            if backup is not None:
+                os.replace(path, backup)
+            with open(path + ".tmp", "w") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+
+    def commit(self):
+        if self._dry_run:
+            return
+        # Removing the journal is the commit point, the backups are still
+        # needed to roll back until it is gone
+        os.remove(self._journal)
+        for operation in self._operations:
+            if operation["op"] == "write" and operation["backup"] is not None:
+                os.remove(operation["backup"])
+
+    def rollback(self):
+        if self._dry_run:
+            return
+        _rollback(self._journal, self._operations)
+
+
+def _rollback(journal, operations):
+    for operation in reversed(operations):
+        _logger.debug("Rolling back %r", operation)
+        if operation["op"] == "makedirs":
+            try:
+                os.rmdir(operation["path"])
+            except OSError:
+                pass
+        elif operation["op"] == "rename":
+            if os.path.exists(operation["dst"]) and not os.path.exists(
+                operation["src"]
+            ):
+                os.rename(operation["dst"], operation["src"])
+        elif operation["op"] == "write":
+            if operation["backup"] is not None:
+                if os.path.exists(operation["backup"]):
+                    os.replace(operation["backup"], operation["path"])
+            elif os.path.exists(operation["path"]):
+                os.remove(operation["path"])
+    if os.path.exists(journal):
+        os.remove(journal)
+
+
+def recover(path):
+    """Roll back a migration step that was interrupted, return True if so"""
+    journal = os.path.join(path, _JOURNAL_FILE)
+    if not os.path.exists(journal):
+        return False
+    operations = []
+    with open(journal, "r") as f:
+        for line in f:
+            try:
+                operations.append(json.loads(line))
+            except ValueError:
+                # Torn last line, that operation was never started
+                break
+    _logger.warning("Rolling back interrupted migration of %s", path)
+    _rollback(journal, operations)
+    return True
+
+
+def upgrade(path, version, target, version_file, dry_run=False):
+    """Upgrade a device folder one version at a time
+
+    Each step runs in its own transaction and ends by writing the new
+    version to version_file, so a failed step is rolled back and leaves
+    the folder at the last good version. Returns a list of (version,
+    description, operations) for the steps, which in dry run mode are
+    planned against the current state of the folder.
+    """
+    steps = []
+    for current in range(version, target):
+        if current not in _migrations:
+            raise MigrationError(
+                "No migration from profile version {0}".format(current)
+            )
+        description, function = _migrations[current]
+        _logger.info("Migrating %s to version %d: %s", path, current + 1, description)
+        transaction = Transaction(path, dry_run)
+        try:
+            function(transaction, path)
+            transaction.write(os.path.join(path, version_file), str(current + 1))
+        except Exception as e:
+            _logger.exception("Migration to version %d failed", current + 1)
+            transaction.rollback()
+            raise MigrationError(
+                "Migration to version {0} failed: {1}".format(current + 1, e)
+            )
+        transaction.commit()
+        steps.append((current, description, transaction.get_operations()))
+    return steps
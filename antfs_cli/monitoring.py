@@ -0,0 +1,244 @@
+# Monitoring
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import bisect
+import datetime
+import json
+import logging
+import os
+import struct
+import threading
+
+from . import archive
+from . import fit
+from . import storage
+from . import utilities
+
+_logger = logging.getLogger()
+
+MONITORING_MESSAGE = 55
+MONITORING_INFO_MESSAGE = 103
+
+_TIMESTAMP_16_FIELD = 26
+# Activity type in the low five bits and intensity in the high three bits,
+# used instead of the activity_type and intensity fields by some devices
+_ACTIVITY_TYPE_INTENSITY_FIELD = 24
+
+# Fields of a sample: name, field number and struct format. Values are
+# stored as in the FIT file, missing values as the FIT invalid value. The
+# timestamp is converted to seconds since the Unix epoch.
+FIELDS = [
+    ("timestamp", fit.TIMESTAMP_FIELD, "I", 0),
+    ("activity_type", 5, "B", 0xFF),
+    ("intensity", 28, "B", 0xFF),
+    ("heart_rate", 27, "B", 0xFF),
+    ("cycles", 3, "I", 0xFFFFFFFF),
+    ("distance", 2, "I", 0xFFFFFFFF),
+    ("active_calories", 19, "H", 0xFFFF),
+    ("active_time", 4, "I", 0xFFFFFFFF),
+]
+
+_SAMPLE = struct.Struct("<" + "".join(f for _, _, f, _ in FIELDS))
+
+# Values that do not fit a column, e.g. from a wider base type, are stored
+# as invalid
+_COLUMNS = [
+    (number, 1 << (8 * struct.calcsize("<" + f)), invalid)
+    for _, number, f, invalid in FIELDS
+]
+
+_MERGED_FILE = "merged.json"
+
+
+def decode_samples(fd):
+    """Decode the monitoring messages of a FIT file into sample tuples"""
+    samples = []
+    timestamp = None
+    for number, message in fit.read_messages(
+        fd, [MONITORING_MESSAGE, MONITORING_INFO_MESSAGE]
+    ):
+        if message.get(fit.TIMESTAMP_FIELD) is not None:
+            timestamp = message[fit.TIMESTAMP_FIELD]
+        elif message.get(_TIMESTAMP_16_FIELD) is not None and timestamp is not None:
+            # The low 16 bits of the timestamp, relative to the last full one
+            timestamp += (message[_TIMESTAMP_16_FIELD] - timestamp) & 0xFFFF
+        else:
+            continue
+        if number != MONITORING_MESSAGE:
+            continue
+        message[fit.TIMESTAMP_FIELD] = timestamp + fit.EPOCH_OFFSET
+        combined = message.get(_ACTIVITY_TYPE_INTENSITY_FIELD)
+        if isinstance(combined, int):
+            message.setdefault(5, combined & 0x1F)
+            message.setdefault(28, combined >> 5)
+        samples.append(
+            tuple(
+                (
+                    message[n]
+                    if isinstance(message.get(n), int) and 0 <= message[n] < limit
+                    else invalid
+                )
+                for n, limit, invalid in _COLUMNS
+            )
+        )
+    return samples
+
+
+def _day(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%d")
+
+
+class MonitoringStore:
+    """Per device time series of monitoring samples, one file per day
+
+    A day file, <directory>/<serial>/<YYYY-MM-DD>.bin, holds fixed-width
+    samples sorted by timestamp and activity type. Days are in UTC. Merging
+    a monitoring file replaces samples with the same timestamp and activity
+    type, so overlapping files are only stored once.
+    """
+
+    def __init__(self, config_dir, directory=None):
+        self._config_dir = config_dir
+        self._directory = directory or os.path.join(config_dir, "monitoring")
+        self._lock = threading.RLock()
+
+    def get_directory(self):
+        return self._directory
+
+    def _get_day_path(self, serial, day):
+        return os.path.join(self._directory, str(serial), day + ".bin")
+
+    def _read_day(self, serial, day):
+        try:
+            with open(self._get_day_path(serial, day), "rb") as f:
+                data = f.read()
+        except IOError:
+            return []
+        return list(_SAMPLE.iter_unpack(data))
+
+    def _write_day(self, serial, day, samples):
+        path = self._get_day_path(serial, day)
+        with open(path + ".tmp", "wb") as f:
+            f.write(b"".join(_SAMPLE.pack(*sample) for sample in samples))
+        os.replace(path + ".tmp", path)
+
+    def merge(self, serial, samples):
+        """Merge samples into the day files, return the number of new ones"""
+        days = {}
+        for sample in samples:
+            days.setdefault(_day(sample[0]), []).append(sample)
+
+        added = 0
+        with self._lock:
+            utilities.makedirs_if_not_exists(os.path.join(self._directory, str(serial)))
+            for day, new in days.items():
+                merged = dict((s[:2], s) for s in self._read_day(serial, day))
+                before = len(merged)
+                merged.update((s[:2], s) for s in new)
+                added += len(merged) - before
+                self._write_day(serial, day, [merged[k] for k in sorted(merged)])
+        return added
+
+    def query(self, serial, start, end):
+        """Samples with start <= timestamp < end (seconds since the epoch)"""
+        samples = []
+        day = datetime.datetime.utcfromtimestamp(start).date()
+        while day <= datetime.datetime.utcfromtimestamp(max(start, end - 1)).date():
+            stored = self._read_day(serial, day.strftime("%Y-%m-%d"))
+            timestamps = [sample[0] for sample in stored]
+            samples.extend(
+                stored[
+                    bisect.bisect_left(timestamps, start) : bisect.bisect_left(
+                        timestamps, end
+                    )
+                ]
+            )
+            day += datetime.timedelta(days=1)
+        return samples
+
+    def _load_merged(self, serial):
+        try:
+            with open(os.path.join(self._directory, str(serial), _MERGED_FILE)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_merged(self, serial, merged):
+        path = os.path.join(self._directory, str(serial), _MERGED_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(merged, f)
+        os.replace(path + ".tmp", path)
+
+    def merge_file(self, store, serial, name, merged=None):
+        """Merge one monitoring file unless already merged
+
+        merged is the record of merged files, it is read and saved here if
+        not given. Returns the number of new samples, None if skipped.
+        """
+        folder = archive._filetypes[archive.FileType.MONITORING_B]
+        stat = os.stat(store.get_path(folder, name))
+        key = [stat.st_mtime_ns, stat.st_size]
+        with self._lock:
+            save = merged is None
+            if save:
+                merged = self._load_merged(serial)
+            if merged.get(name) == key:
+                return None
+            try:
+                with store.open(folder, name) as fd:
+                    samples = decode_samples(fd)
+            except (fit.FitError, struct.error, IndexError, OverflowError) as e:
+                _logger.warning("Could not merge %s: %s", name, e)
+                return None
+            added = self.merge(serial, samples)
+            merged[name] = key
+            if save:
+                self._save_merged(serial, merged)
+            return added
+
+    def update(self, serials=None):
+        """Merge all new or changed monitoring files, return the new count"""
+        folder = archive._filetypes[archive.FileType.MONITORING_B]
+        added = 0
+        for serial in serials or archive.get_devices(self._config_dir):
+            path = os.path.join(self._config_dir, str(serial))
+            store = storage.Storage(path, layout=archive.get_layout(path))
+            with self._lock:
+                merged = self._load_merged(serial)
+                for name in sorted(store.list(folder)):
+                    added += self.merge_file(store, serial, name, merged) or 0
+                if merged:
+                    self._save_merged(serial, merged)
+        return added
+
+    def on_action(self, action, filename, fit_type):
+        """scripting.Runner hook, merges monitoring files as downloaded"""
+        if action != "DOWNLOAD" or fit_type != archive.FileType.MONITORING_B:
+            return
+        serial = archive.get_serial(
+            filename, archive._filetypes[archive.FileType.MONITORING_B]
+        )
+        if serial is None:
+            return
+        path = os.path.join(self._config_dir, serial)
+        store = storage.Storage(path, layout=archive.get_layout(path))
+        self.merge_file(store, serial, os.path.basename(filename))
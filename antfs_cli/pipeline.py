@@ -0,0 +1,115 @@
+# Pipeline
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import io
+import logging
+import os
+import queue
+import threading
+import time
+
+from . import fit
+from . import fsck
+
+_logger = logging.getLogger()
+
+
+class Pipeline:
+    """Stores downloaded files in a background thread
+
+    The transfer loop hands over each downloaded buffer with submit and can
+    start the next download right away. In the background the FIT CRC is
+    checked and the file written and synced to disk, then
+    on_stored(folder, name, fit_type, path, error, elapsed) is called, in
+    the same thread, for indexing and scripts. Files failing the check are
+    stored with fsck.CORRUPT_SUFFIX, so they are downloaded again on the
+    next sync. At most depth buffers wait, after which submit blocks.
+    """
+
+    _STOP = None
+
+    def __init__(self, storage, depth=2):
+        self._storage = storage
+        self._queue = queue.Queue(depth)
+        self._thread = threading.Thread(target=self._run, name="pipeline")
+        self._thread.daemon = True
+        self.on_stored = None
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, folder, name, data, fit_type):
+        # One immutable copy, shared by the check and the write, so the
+        # downloaded array can be freed right away
+        self._queue.put((folder, name, bytes(data), fit_type))
+
+    def _store(self, folder, name, data, fit_type):
+        start_time = time.time()
+        error = None
+        target = name
+        try:
+            fit.check(io.BytesIO(data))
+        except fit.FitError as e:
+            error = str(e)
+            _logger.warning("Downloaded %s is bad: %s", name, error)
+            target += fsck.CORRUPT_SUFFIX
+        try:
+            path = self._storage.write(folder, target, data, sync=True)
+            if error is not None:
+                # Written under a name the scan ignores, then named as fsck
+                # names bad files, e.g. x.fit.gz.corrupt
+                directory, filename = os.path.split(path)
+                stored = name + filename[len(target) :]
+                corrupt = fsck.get_corrupt_path(os.path.join(directory, stored))
+                os.replace(path, corrupt)
+                path = corrupt
+        except (IOError, OSError) as e:
+            _logger.exception("Could not store %s", name)
+            path, error = None, str(e)
+        if self.on_stored is not None:
+            self.on_stored(
+                folder, name, fit_type, path, error, time.time() - start_time
+            )
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is self._STOP:
+                    return
+                self._store(*item)
+            except Exception:
+                _logger.exception("Pipeline stage failed")
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        """Wait until all submitted files are stored"""
+        if self._thread.is_alive():
+            self._queue.join()
+
+    def close(self):
+        """Store the remaining files and stop the thread"""
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join()
@@ -0,0 +1,148 @@
+# Profiling
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import cProfile
+import io
+import logging
+import pstats
+import time
+import tracemalloc
+
+_logger = logging.getLogger()
+
+KINDS = ["cpu", "mem"]
+
+# Functions or allocation sites listed per phase
+_TOP = 25
+
+
+class ProfilingError(Exception):
+    def __init__(self, message):
+        super(ProfilingError, self).__init__(message)
+
+
+class Profiler:
+    """Profiles a session, one section per phase
+
+    With "cpu" each phase is run under its own cProfile profiler, in the
+    thread calling start and phase (the transfer loop). With "mem"
+    tracemalloc snapshots are taken at the phase boundaries, giving the
+    current and peak traced memory of each phase and the allocation sites
+    that grew the most. stop writes the reports to files starting with
+    prefix and returns their paths.
+    """
+
+    def __init__(self, kind, prefix):
+        if kind not in KINDS:
+            raise ProfilingError("Unknown profile {0}".format(kind))
+        self._kind = kind
+        self._prefix = prefix
+        self._phase = None
+        self._phase_start = None
+        self._profile = None
+        self._snapshot = None
+        # (name, seconds, cProfile.Profile or (current, peak, top stats))
+        self._phases = []
+
+    def start(self, name="start"):
+        if self._kind == "mem":
+            tracemalloc.start()
+            self._snapshot = tracemalloc.take_snapshot()
+        self._begin(name)
+
+    def _begin(self, name):
+        self._phase = name
+        self._phase_start = time.time()
+        if self._kind == "cpu":
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def _end(self):
+        elapsed = time.time() - self._phase_start
+        if self._kind == "cpu":
+            self._profile.disable()
+            self._phases.append((self._phase, elapsed, self._profile))
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        top = snapshot.compare_to(self._snapshot, "lineno")[:_TOP]
+        self._snapshot = snapshot
+        self._phases.append((self._phase, elapsed, (current, peak, top)))
+        if hasattr(tracemalloc, "reset_peak"):
+            # Python 3.9 and later, before that peaks are since the start
+            tracemalloc.reset_peak()
+
+    def phase(self, name):
+        """End the current phase and start the next"""
+        if self._phase is None:
+            return
+        _logger.debug("profile phase %s", name)
+        self._end()
+        self._begin(name)
+
+    def stop(self):
+        if self._phase is None:
+            return []
+        self._end()
+        self._phase = None
+        if self._kind == "mem":
+            tracemalloc.stop()
+            return [self._write_mem()]
+        return self._write_cpu()
+
+    def _write_cpu(self):
+        stats = None
+        report = io.StringIO()
+        for name, elapsed, profile in self._phases:
+            report.write("=== {0} ({1:.3f} s)\n".format(name, elapsed))
+            phase_stats = pstats.Stats(profile, stream=report)
+            phase_stats.sort_stats("cumulative").print_stats(_TOP)
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        stats.dump_stats(self._prefix + "-cpu.prof")
+        with open(self._prefix + "-cpu.txt", "w") as f:
+            f.write(report.getvalue())
+        return [self._prefix + "-cpu.prof", self._prefix + "-cpu.txt"]
+
+    def _write_mem(self):
+        with open(self._prefix + "-mem.txt", "w") as f:
+            for name, elapsed, (current, peak, top) in self._phases:
+                f.write(
+                    "=== {0} ({1:.3f} s) current {2} KiB, peak {3} KiB\n".format(
+                        name, elapsed, current // 1024, peak // 1024
+                    )
+                )
+                for stat in top:
+                    f.write("{0}\n".format(stat))
+                f.write("\n")
+        return self._prefix + "-mem.txt"
+
+    def get_peaks(self):
+        """(phase, peak traced bytes) of the finished phases, for "mem" """
+        if self._kind != "mem":
+            return []
+        return [(name, data[1]) for name, _, data in self._phases]
@@ -24,7 +24,7 @@
 
 import array
 import logging
-import datetime
+import struct
 import time
 from argparse import ArgumentParser
 import os
@@ -38,177 +38,203 @@ from ant.fs.manager import (
     AntFSDownloadException,
 )
 from ant.fs.manager import AntFSUploadException
-from ant.fs.file import File
-
+from ant.base.message import Message
+
+from . import commands
+from . import dedup
+from . import events
+from . import export
+from . import index
+from . import monitoring
+from . import pipeline
+from . import profiling
+from . import search
+from .archive import Device, _directories, _filetypes
 from . import utilities
 from . import scripting
 
 _logger = logging.getLogger()
 
-_directories = {
-    ".": File.Identifier.DEVICE,
-    "activities": File.Identifier.ACTIVITY,
-    "courses": File.Identifier.COURSE,
-    "waypoints": File.Identifier.WAYPOINTS,
-    "monitoring_b": File.Identifier.MONITORING_B,
-    # "profile":     File.Identifier.?
-    # "goals?":      File.Identifier.GOALS,
-    # "bloodprs":    File.Identifier.BLOOD_PRESSURE,
-    # "summaries":   File.Identifier.ACTIVITY_SUMMARY,
-    "settings": File.Identifier.SETTING,
-    "sports": File.Identifier.SPORT,
-    "totals": File.Identifier.TOTALS,
-    "weight": File.Identifier.WEIGHT,
-    "workouts": File.Identifier.WORKOUT,
-}
-
-_filetypes = dict((v, k) for (k, v) in _directories.items())
-
-
-class Device:
-    class ProfileVersionException(Exception):
-        pass
-
-    _PROFILE_VERSION = 1
-    _PROFILE_VERSION_FILE = "profile_version"
-
-    def __init__(self, basedir, serial, name):
-        self._path = os.path.join(basedir, str(serial))
-        self._serial = serial
-        self._name = name
-
-        # Check profile version, if not a new device
-        if os.path.isdir(self._path):
-            if self.get_profile_version() < self._PROFILE_VERSION:
-                raise Device.ProfileVersionException(
-                    "Profile version mismatch, too old"
-                )
-            elif self.get_profile_version() > self._PROFILE_VERSION:
-                raise Device.ProfileVersionException(
-                    "Profile version mismatch, too new"
-                )
-
-        # Create directories
-        utilities.makedirs_if_not_exists(self._path)
-        for directory in _directories:
-            directory_path = os.path.join(self._path, directory)
-            utilities.makedirs_if_not_exists(directory_path)
-
-        # Write profile version (If none)
-        path = os.path.join(self._path, self._PROFILE_VERSION_FILE)
-        if not os.path.exists(path):
-            with open(path, "w") as f:
-                f.write(str(self._PROFILE_VERSION))
-
-    def get_path(self):
-        return self._path
-
-    def get_serial(self):
-        return self._serial
-
-    def get_name(self):
-        return self._name
-
-    def get_profile_version(self):
-        path = os.path.join(self._path, self._PROFILE_VERSION_FILE)
-        try:
-            with open(path, "rb") as f:
-                return int(f.read())
-        except IOError as e:
-            # TODO
-            return 0
-
-    def read_passkey(self):
-        try:
-            with open(os.path.join(self._path, "authfile"), "rb") as f:
-                d = array.array("B", f.read())
-                _logger.debug("loaded authfile: %r", d)
-                return d
-        except:
-            return None
-
-    def write_passkey(self, passkey):
-        with open(os.path.join(self._path, "authfile"), "wb") as f:
-            passkey.tofile(f)
-            _logger.debug("wrote authfile: %r, %r", self._serial, passkey)
-
 
 class AntFSCLI(Application):
     PRODUCT_NAME = "antfs-cli"
 
-    def __init__(self, config_dir, args):
-        Application.__init__(self)
-
+    def __init__(self, config_dir, args, profiler=None, stream=None):
+        # Used by setup_channel and stop, called from Application.__init__
+        self._profiler = profiler
+        self._events = (
+            events.JsonEvents(stream) if args.json else events.TextEvents(stream)
+        )
+        self._start_time = time.time()
+        self._migration = None
+        self._pipeline = None
+        self._search = None
+        self._channel_parameters = None
         self.config_dir = config_dir
+        # Before the ANT stick is opened, raises ExportError if not available
+        exporter = None
+        if args.export is not None:
+            exporter = export.Exporter(self.config_dir, format=args.export)
+
+        Application.__init__(self)
 
         # Set up scripting
         scripts_dir = os.path.join(self.config_dir, "scripts")
         utilities.makedirs_if_not_exists(scripts_dir)
         self.scriptr = scripting.Runner(scripts_dir)
+        self.scriptr.on_result = self._on_script_result
+        if args.json:
+            # Keep stdout for the events only
+            self.scriptr.stdout = sys.stderr
+        self._index = index.Index(self.config_dir)
+        if exporter is not None:
+            self.scriptr.hooks.append(exporter.on_action)
+        if args.monitoring:
+            self.scriptr.hooks.append(
+                monitoring.MonitoringStore(self.config_dir).on_action
+            )
 
         self._device = None
         self._uploading = args.upload
         self._pair = args.pair
         self._skip_archived = args.skip_archived
+        self._compression = args.compress
+        self._layout = args.layout
 
     def setup_channel(self, channel):
-        channel.set_period(4096)
-        channel.set_search_timeout(255)
-        channel.set_rf_freq(50)
-        channel.set_search_waveform([0x53, 0x00])
-        channel.set_id(0, 0x01, 0)
+        self._search_channel = channel
+        self._search_opened = False
+        self._search = search.Search(
+            self._open_channel, search.get_recent(self.config_dir)
+        )
+        self._search.start()
+
+    def _open_channel(self, serial, parameters, search_timeout):
+        """Open a search for the given device, or any device if serial is None"""
+        channel = self._search_channel
+        if self._search_opened:
+            # Normally closed already, by the search timeout
+            try:
+                channel.close()
+            except Exception:
+                _logger.debug("Could not close the search channel", exc_info=True)
+        channel.set_period(parameters["period"])
+        channel.set_search_timeout(search_timeout)
+        channel.set_rf_freq(search.RF_FREQUENCY)
+        channel.set_search_waveform(search.SEARCH_WAVEFORM)
+        channel.set_id(
+            parameters["device_number"],
+            parameters["device_type"],
+            parameters["transmission_type"],
+        )
 
         channel.open()
+        self._search_opened = True
         # channel.request_message(Message.ID.RESPONSE_CHANNEL_STATUS)
-        print("Searching...")
+        self._events.emit("search", serial=serial)
+
+    def _get_channel_parameters(self, beacon, latency):
+        """Channel parameters of the found device, to search for it directly
+        next time"""
+        try:
+            _, _, data = self._search_channel.request_message(
+                Message.ID.RESPONSE_CHANNEL_ID
+            )
+            number, device_type, transmission_type = struct.unpack(
+                "<HBB", bytes(data[:4])
+            )
+        except Exception:
+            _logger.debug("Could not read the channel id", exc_info=True)
+            return None
+        return {
+            "device_number": number,
+            "device_type": device_type,
+            "transmission_type": transmission_type,
+            "period": search.get_period(beacon.get_channel_period()),
+            "seen": time.time(),
+            "latency": latency,
+        }
+
+    def stop(self):
+        if self._search is not None:
+            self._search.stop()
+        if self._pipeline is not None:
+            # Store what has been downloaded, also when interrupted
+            self._pipeline.close()
+        if self._migration is not None:
+            self._migration.stop()
+        Application.stop(self)
+
+    def _phase(self, name):
+        if self._profiler is not None:
+            self._profiler.phase(name)
 
     def on_link(self, beacon):
+        self._phase("link")
         _logger.debug("on link, %r, %r", beacon.get_serial(), beacon.get_descriptor())
+        targeted, latency = self._search.linked()
+        self._channel_parameters = self._get_channel_parameters(beacon, latency)
+        self._events.emit(
+            "link",
+            serial=beacon.get_serial(),
+            descriptor=beacon.get_descriptor(),
+            targeted=targeted,
+            latency=latency,
+        )
         self.link()
         return True
 
     def on_authentication(self, beacon):
+        self._phase("authentication")
         _logger.debug("on authentication")
         serial, name = self.authentication_serial()
-        self._device = Device(self.config_dir, serial, name)
+        self._device = Device(
+            self.config_dir, serial, name, self._compression, self._layout
+        )
+        self._serial = serial
+        if self._channel_parameters is not None:
+            self._device.write_channel(self._channel_parameters)
+        self._migration = self._device.get_migration()
+        self._migration.start()
+        self._pipeline = pipeline.Pipeline(self._device.get_storage())
+        self._pipeline.on_stored = self._on_stored
+        self._pipeline.start()
 
         passkey = self._device.read_passkey()
-        print("Authenticating with", name, "(" + str(serial) + ")")
+        self._events.emit("authenticate", name=name, serial=serial)
         _logger.debug("serial %s, %r, %r", name, serial, passkey)
 
         if passkey is not None and not self._pair:
             try:
-                print(" - Passkey:", end=" ")
-                sys.stdout.flush()
+                self._events.emit("auth_start", method="passkey")
                 self.authentication_passkey(passkey)
-                print("OK")
+                self._events.emit("auth_result", method="passkey", ok=True)
                 return True
             except AntFSAuthenticationException as e:
-                print("FAILED")
+                self._events.emit("auth_result", method="passkey", ok=False)
                 return False
         else:
             try:
-                print(" - Pairing:", end=" ")
-                sys.stdout.flush()
+                self._events.emit("auth_start", method="pairing")
                 passkey = self.authentication_pair(self.PRODUCT_NAME)
                 self._device.write_passkey(passkey)
-                print("OK")
+                self._events.emit("auth_result", method="pairing", ok=True)
                 return True
             except AntFSAuthenticationException as e:
-                print("FAILED")
+                self._events.emit("auth_result", method="pairing", ok=False)
                 return False
 
     def on_transport(self, beacon):
+        self._phase("directory")
 
         # Adjust time
-        print(" - Set time:", end=" ")
         try:
             result = self.set_time()
         except (AntFSTimeException, AntFSDownloadException, AntFSUploadException) as e:
-            print("FAILED")
+            self._events.emit("set_time", ok=False)
             _logger.exception("Could not set time")
         else:
-            print("OK")
+            self._events.emit("set_time", ok=True)
 
         directory = self.download_directory()
         # directory.print_list()
@@ -216,10 +242,8 @@ class AntFSCLI(Application):
         # Map local filenames to FIT file types
         local_files = []
         for folder, filetype in _directories.items():
-            path = os.path.join(self._device.get_path(), folder)
-            for filename in os.listdir(path):
-                if os.path.splitext(filename)[1].lower() == ".fit":
-                    local_files.append((filename, filetype))
+            for filename in self._device.get_storage().list(folder):
+                local_files.append((filename, filetype))
 
         # Map remote filenames to FIT file objects
         remote_files = []
@@ -245,15 +269,22 @@ class AntFSCLI(Application):
         if self._skip_archived:
             downloading = [fil for fil in downloading if not fil.is_archived()]
 
-        print("Downloading", len(downloading), "file(s)")
-        if self._uploading:
-            print(" and uploading", len(uploading), "file(s)")
+        self._events.emit(
+            "directory",
+            local=len(local_files),
+            remote=len(remote_files),
+            downloading=len(downloading),
+            uploading=len(uploading) if self._uploading else None,
+        )
 
-        # Download missing files:
+        # Download missing files, stored in the background
+        self._phase("download")
         for fileobject in downloading:
             self.download_file(fileobject)
+        self._pipeline.join()
 
         # Upload missing files:
+        self._phase("upload")
         if uploading and self._uploading:
             # Upload
             results = {}
@@ -268,14 +299,27 @@ class AntFSCLI(Application):
                     file_object = next(
                         f for f in directory.get_files() if f.get_index() == index
                     )
-                    src = os.path.join(
-                        self._device.get_path(), _filetypes[typ], filename
+                    src, dst = self._device.get_storage().rename(
+                        _filetypes[typ], filename, self.get_filename(file_object)
                     )
-                    dst = self.get_filepath(file_object)
-                    print(" - Renamed", src, "to", dst)
-                    os.rename(src, dst)
+                    self._index.rename(
+                        self._serial,
+                        _filetypes[typ],
+                        filename,
+                        self.get_filename(file_object),
+                    )
+                    self._events.emit("rename", src=src, dst=dst)
                 except Exception as e:
-                    print(" - Failed", index, filename, e)
+                    self._events.emit(
+                        "rename_failed", index=index, name=filename, error=str(e)
+                    )
+
+        self._events.emit(
+            "summary",
+            downloaded=len(downloading),
+            uploaded=len(uploading) if self._uploading else 0,
+            elapsed=time.time() - self._start_time,
+        )
 
     def get_filename(self, fil):
         return "{0}_{1}_{2}.fit".format(
@@ -285,57 +329,95 @@ class AntFSCLI(Application):
         )
 
     def get_filepath(self, fil):
-        return os.path.join(
-            self._device.get_path(),
-            _filetypes[fil.get_fit_sub_type()],
-            self.get_filename(fil),
+        return self._device.get_storage().get_path(
+            _filetypes[fil.get_fit_sub_type()], self.get_filename(fil)
         )
 
     def download_file(self, fil):
-        sys.stdout.write("Downloading {0}: ".format(self.get_filename(fil)))
-        sys.stdout.flush()
-        data = self.download(fil.get_index(), AntFSCLI._get_progress_callback())
-        with open(self.get_filepath(fil), "wb") as fd:
-            data.tofile(fd)
-        sys.stdout.write("\n")
-        sys.stdout.flush()
-
-        self.scriptr.run_download(self.get_filepath(fil), fil.get_fit_sub_type())
+        name = self.get_filename(fil)
+        folder = _filetypes[fil.get_fit_sub_type()]
+        start_time = time.time()
+        self._events.emit(
+            "file_start",
+            action="download",
+            name=name,
+            index=fil.get_index(),
+            size=fil.get_size(),
+            fit_type=fil.get_fit_sub_type(),
+        )
+        data = self.download(
+            fil.get_index(), self._get_progress_callback("download", name)
+        )
+        self._events.emit(
+            "file_done",
+            action="download",
+            name=name,
+            size=len(data),
+            elapsed=time.time() - start_time,
+        )
+        self._pipeline.submit(folder, name, data, fil.get_fit_sub_type())
+
+    def _on_stored(self, folder, name, fit_type, path, error, elapsed):
+        """Called by the pipeline thread once a downloaded file is stored"""
+        self._events.emit("stored", name=name, path=path, error=error, elapsed=elapsed)
+        if error is not None:
+            return
+        self._index.add(self._serial, folder, name)
+        self.scriptr.run_download(
+            self._device.get_storage().local_path(folder, name),
+            fit_type,
+            self._device.get_path(),
+        )
 
     def upload_file(self, typ, filename):
-        sys.stdout.write("Uploading {0}: ".format(filename))
-        sys.stdout.flush()
-        with open(
-            os.path.join(self._device.get_path(), _filetypes[typ], filename), "rb"
-        ) as fd:
-            data = array.array("B", fd.read())
-        index = self.create(typ, data, AntFSCLI._get_progress_callback())
-        sys.stdout.write("\n")
-        sys.stdout.flush()
+        start_time = time.time()
+        self._events.emit("file_start", action="upload", name=filename, fit_type=typ)
+        data = array.array(
+            "B", self._device.get_storage().read(_filetypes[typ], filename)
+        )
+        index = self.create(typ, data, self._get_progress_callback("upload", filename))
+        self._events.emit(
+            "file_done",
+            action="upload",
+            name=filename,
+            index=index,
+            size=len(data),
+            elapsed=time.time() - start_time,
+        )
         return index
 
-    @staticmethod
-    def _get_progress_callback():
+    def _get_progress_callback(self, action, name):
         start_time = time.time()
 
         def callback(new_progress):
-            s = "[{0:<30}]".format("." * int(new_progress * 30))
-            if new_progress == 0:
-                s += " started"
-            else:
-                delta = time.time() - start_time
-                eta = datetime.timedelta(seconds=int(delta / new_progress - delta))
-                s += " ETA: {0}".format(eta)
-            sys.stdout.write(s)
-            sys.stdout.flush()
-            sys.stdout.write("\b" * len(s))
+            self._events.emit(
+                "progress",
+                action=action,
+                name=name,
+                progress=new_progress,
+                elapsed=time.time() - start_time,
+            )
 
         return callback
 
+    def _on_script_result(self, script, action, filename, fit_type, returncode, error):
+        self._events.emit(
+            "script",
+            script=script,
+            action=action,
+            filename=filename,
+            fit_type=fit_type,
+            returncode=returncode,
+            error=error,
+        )
+
 
 def main():
     parser = ArgumentParser(
-        description="Extracts FIT files from ANT-FS based sport watches."
+        description="Extracts FIT files from ANT-FS based sport watches.",
+        epilog="Other commands: {0}, see '{1} <command> --help'.".format(
+            ", ".join(commands.get_commands()), AntFSCLI.PRODUCT_NAME
+        ),
     )
     parser.add_argument("--upload", action="store_true", help="enable uploading")
     parser.add_argument("--debug", action="store_true", help="enable debug")
@@ -348,6 +430,44 @@ def main():
         action="store_true",
         help="don't download files marked as 'archived' on the watch",
     )
+    parser.add_argument(
+        "--compress",
+        choices=["gzip", "zstd"],
+        help="store newly downloaded files compressed",
+    )
+    parser.add_argument(
+        "--layout",
+        choices=["flat", "date"],
+        help="store files in one folder per type, or in year and month "
+        "folders, existing files are moved in the background",
+    )
+    parser.add_argument(
+        "--export",
+        choices=["npz", "parquet"],
+        help="keep a columnar copy of the records of downloaded activities",
+    )
+    parser.add_argument(
+        "--monitoring",
+        action="store_true",
+        help="merge downloaded monitoring files into a daily time series",
+    )
+    parser.add_argument(
+        "--dedup",
+        choices=dedup.METHODS,
+        help="after syncing, replace identical files of all devices by "
+        "hardlinks or reflinks to one copy",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=profiling.KINDS,
+        help="profile CPU time (cProfile) or memory (tracemalloc) of each "
+        "phase of the session, reports are written next to the log",
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="write progress as newline delimited JSON events to stdout",
+    )
     args = parser.parse_args()
 
     # Set up config dir
@@ -378,27 +498,59 @@ def main():
     if args.debug:
         _logger.addHandler(logging.StreamHandler())
 
+    profiler = None
+    if args.profile is not None:
+        # Reports are written next to the log, e.g. <log name>-cpu.txt
+        profiler = profiling.Profiler(args.profile, os.path.splitext(log_filename)[0])
+        profiler.start("search")
+
+    stream = sys.stdout
+    if args.json:
+        # The events get the real stdout, anything else printed during the
+        # session (openant, hooks) goes to stderr
+        sys.stdout = sys.stderr
+
     try:
-        g = AntFSCLI(config_dir, args)
+        g = AntFSCLI(config_dir, args, profiler, stream)
         try:
             g.start()
         finally:
             g.stop()
+        if args.dedup is not None:
+            # After stop, so the layout migration is not moving files
+            files, saved = dedup.dedup(config_dir, method=args.dedup)
+            _logger.info("Linked %d duplicate file(s), %d bytes", files, saved)
     except Device.ProfileVersionException as e:
+        if args.json:
+            events.JsonEvents(stream).emit("error", error=str(e))
+            return
         print(
             "\nError: %s\n\nThis means that %s found that your data directory "
-            "structure was too old or too new. The best option is "
-            "probably to let %s recreate your "
-            "folder by deleting your data folder, after backing it up, "
-            "and let all your files be redownloaded from your sports "
-            "watch." % (e, AntFSCLI.PRODUCT_NAME, AntFSCLI.PRODUCT_NAME)
+            "structure was too new, or that it could not be upgraded. Any "
+            "partial upgrade has been rolled back, see the log for details. "
+            "Run '%s migrate --dry-run' to see what an upgrade would do."
+            % (e, AntFSCLI.PRODUCT_NAME, AntFSCLI.PRODUCT_NAME)
         )
+    except export.ExportError as e:
+        if args.json:
+            events.JsonEvents(stream).emit("error", error=str(e))
+        else:
+            print("Error:", e)
+        return 1
     except (Exception, KeyboardInterrupt) as e:
         traceback.print_exc()
         for line in traceback.format_exc().splitlines():
             _logger.error("%r", line)
-        print("Interrupted:", str(e))
+        if args.json:
+            events.JsonEvents(stream).emit("error", error=str(e))
+        else:
+            print("Interrupted:", str(e))
         return 1
+    finally:
+        sys.stdout = stream
+        if profiler is not None:
+            for path in profiler.stop():
+                _logger.info("Wrote profile %s", path)
 
 
 if __name__ == "__main__":
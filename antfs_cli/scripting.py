@@ -21,15 +21,29 @@
 # DEALINGS IN THE SOFTWARE.
 
 import errno
+import logging
 import os
 import subprocess
 import threading
 
+_logger = logging.getLogger()
+
 
 class Runner:
     def __init__(self, directory):
         self.directory = directory
 
+        # Called as on_result(script, action, filename, fit_type, returncode,
+        # error) once a script has finished, error is an errno or None
+        self.on_result = self._print_result
+
+        # Functions called as hook(action, filename, fit_type) before the
+        # scripts, in the same background thread
+        self.hooks = []
+
+        # File the scripts write their output to, None for our stdout
+        self.stdout = None
+
         # TODO: loop over scripts, check if they are runnable, warn
         # then don't warn at runtime.
 
@@ -40,35 +54,69 @@ class Runner:
                 scripts.append(filename)
         return sorted(scripts)
 
-    def _run_action(self, action, filename, fit_type):
-        for script in self.get_scripts():
+    def _run_action(self, action, filename, fit_type, device_dir):
+        scripts = self.get_scripts()
+        if not scripts and not self.hooks:
+            return
+        if isinstance(filename, str):
+            self._run_scripts(scripts, action, filename, fit_type, device_dir)
+        else:
+            # A context manager providing the file, e.g. decompressed to a
+            # temporary file, only entered if there is something to run
+            with filename as path:
+                self._run_scripts(scripts, action, path, fit_type, device_dir)
+
+    def _run_scripts(self, scripts, action, filename, fit_type, device_dir=None):
+        for hook in self.hooks:
+            try:
+                hook(action, filename, fit_type)
+            except Exception:
+                _logger.exception("Hook %r failed for %s", hook, filename)
+        env = None
+        if device_dir is not None:
+            # The file may be a temporary copy outside the device folder
+            env = dict(os.environ, ANTFS_CLI_DEVICE_DIR=device_dir)
+        for script in scripts:
             try:
-                subprocess.call(
+                returncode = subprocess.call(
                     [
                         os.path.join(self.directory, script),
                         action,
                         filename,
                         str(fit_type),
-                    ]
+                    ],
+                    stdout=self.stdout,
+                    env=env,
                 )
             except OSError as e:
-                print(
-                    " - Could not run",
-                    script,
-                    "-",
-                    errno.errorcode[e.errno],
-                    os.strerror(e.errno),
-                )
+                self.on_result(script, action, filename, fit_type, None, e.errno)
+            else:
+                self.on_result(script, action, filename, fit_type, returncode, None)
+
+    def _print_result(self, script, action, filename, fit_type, returncode, error):
+        if error is not None:
+            print(
+                " - Could not run",
+                script,
+                "-",
+                errno.errorcode[error],
+                os.strerror(error),
+            )
 
-    def run_action(self, action, filename, fit_type):
-        t = threading.Thread(target=self._run_action, args=(action, filename, fit_type))
+    def run_action(self, action, filename, fit_type, device_dir=None):
+        if not self.hooks and not self.get_scripts():
+            # Nothing to run, don't start a thread for it
+            return
+        t = threading.Thread(
+            target=self._run_action, args=(action, filename, fit_type, device_dir)
+        )
         t.start()
 
-    def run_download(self, filename, fit_type):
-        self.run_action("DOWNLOAD", filename, fit_type)
+    def run_download(self, filename, fit_type, device_dir=None):
+        self.run_action("DOWNLOAD", filename, fit_type, device_dir)
 
-    def run_upload(self, filename, fit_type):
-        self.run_action("UPLOAD", filename, fit_type)
+    def run_upload(self, filename, fit_type, device_dir=None):
+        self.run_action("UPLOAD", filename, fit_type, device_dir)
 
-    def run_delete(self, filename, fit_type):
-        self.run_action("DELETE", filename, fit_type)
+    def run_delete(self, filename, fit_type, device_dir=None):
+        self.run_action("DELETE", filename, fit_type, device_dir)
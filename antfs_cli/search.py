@@ -0,0 +1,126 @@
+# Search
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import logging
+import os
+import threading
+import time
+
+from . import archive
+
+_logger = logging.getLogger()
+
+# ANT-FS beacons are sent on the 2450 MHz frequency, with the period given
+# by the low three bits of the first status byte
+RF_FREQUENCY = 50
+SEARCH_WAVEFORM = [0x53, 0x00]
+DEVICE_TYPE = 0x01
+
+_PERIODS = {0: 65535, 1: 32768, 2: 16384, 3: 8192, 4: 4096}
+
+WILDCARD = {
+    "device_number": 0,
+    "device_type": DEVICE_TYPE,
+    "transmission_type": 0,
+    "period": 4096,
+}
+
+# Seconds a targeted search runs before trying the next one, a little over
+# the ANT search timeout so the channel has closed itself
+TARGETED_TIMEOUT = 2
+_TARGETED_WAIT = TARGETED_TIMEOUT * 2.5 + 1.0
+
+
+def get_period(beacon_period):
+    """Channel period for the period bits of a beacon"""
+    return _PERIODS.get(beacon_period, 4096)
+
+
+def get_recent(config_dir, max_age=14 * 24 * 60 * 60, limit=2, now=None):
+    """(serial, channel parameters) of the devices seen in the last max_age
+    seconds, most recent first"""
+    now = time.time() if now is None else now
+    recent = []
+    for serial in archive.get_devices(config_dir):
+        parameters = archive.read_channel(os.path.join(config_dir, str(serial)))
+        if parameters is None or now - parameters.get("seen", 0) > max_age:
+            continue
+        recent.append((serial, parameters))
+    recent.sort(key=lambda item: item[1]["seen"], reverse=True)
+    return recent[:limit]
+
+
+class Search:
+    """Searches for recently seen devices first, then for any device
+
+    configure(serial, parameters, search_timeout) is called to (re)open the
+    channel, with serial None and the wildcard parameters for the last
+    search. Each targeted search is given _TARGETED_WAIT seconds, after
+    which a background thread moves on to the next one. Call linked when a
+    device is found.
+    """
+
+    def __init__(self, configure, recent):
+        self._configure = configure
+        self._steps = [(serial, p) for serial, p in recent] + [(None, WILDCARD)]
+        self._step = 0
+        self._lock = threading.Lock()
+        self._linked = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="search")
+        self._thread.daemon = True
+        self._start_time = None
+
+    def _open(self):
+        serial, parameters = self._steps[self._step]
+        targeted = serial is not None
+        self._configure(serial, parameters, TARGETED_TIMEOUT if targeted else 255)
+
+    def start(self):
+        self._start_time = time.time()
+        self._open()
+        if len(self._steps) > 1:
+            self._thread.start()
+
+    def _run(self):
+        while not self._linked.wait(_TARGETED_WAIT):
+            with self._lock:
+                if self._linked.is_set():
+                    return
+                self._step += 1
+                _logger.debug("targeted search timed out, next %r", self._step)
+                try:
+                    self._open()
+                except Exception:
+                    _logger.exception("Could not reopen the search channel")
+            if self._step == len(self._steps) - 1:
+                return
+
+    def linked(self):
+        """Stop searching, return (serial searched for or None, seconds
+        since the search started)"""
+        with self._lock:
+            self._linked.set()
+            return self._steps[self._step][0], time.time() - self._start_time
+
+    def stop(self):
+        self._linked.set()
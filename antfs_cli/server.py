@@ -0,0 +1,302 @@
+# Server
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import email.utils
+import hashlib
+import json
+import logging
+import os
+import re
+import socketserver
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from . import archive
+from . import index
+from . import storage
+
+_logger = logging.getLogger()
+
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class _RangeError(Exception):
+    def __init__(self, message):
+        super(_RangeError, self).__init__(message)
+
+
+def parse_range(header, size):
+    """Return the (start, end) byte range, end exclusive, of a Range header
+
+    Returns None if the header is missing or not understood (including
+    several ranges), in which case the whole file is sent. Raises
+    _RangeError if the range is not satisfiable.
+    """
+    match = _RANGE.match((header or "").strip())
+    if match is None or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        # The last n bytes
+        start, end = max(0, size - int(last)), size
+    else:
+        start = int(first)
+        end = size if last == "" else min(size, int(last) + 1)
+    if start >= size or start >= end:
+        raise _RangeError("Range not satisfiable")
+    return start, end
+
+
+def _accepts(header, coding):
+    """Whether an Accept-Encoding header allows the content coding"""
+    for item in (header or "").split(","):
+        token, _, parameters = item.strip().partition(";")
+        if token.strip().lower() == coding:
+            quality = parameters.strip().partition("=")[2]
+            try:
+                return float(quality or 1) > 0
+            except ValueError:
+                return False
+    return False
+
+
+def _get_coding(path):
+    for coding, codec in storage._codecs.items():
+        if path.endswith(codec.suffix):
+            return coding
+    return None
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Read-only HTTP API over the archive
+
+    GET /devices lists the devices, /devices/<serial>/files lists the files
+    of a device (filtered by the type, since, until, min_size and max_size
+    query parameters, as for 'antfs-cli ls') and
+    /devices/<serial>/files/<name> returns a file. Responses carry an ETag
+    and files a Last-Modified header, and files can be fetched in ranges.
+    Compressed files are sent as stored, with a Content-Encoding, to
+    clients accepting it, and decompressed otherwise.
+    """
+
+    server_version = "antfs-cli"
+    protocol_version = "HTTP/1.1"
+
+    _routes = [
+        (re.compile(r"^/devices/?$"), "_get_devices"),
+        (re.compile(r"^/devices/(\d+)/files/?$"), "_get_files"),
+        (re.compile(r"^/devices/(\d+)/files/([^/]+)$"), "_get_file"),
+    ]
+
+    def do_GET(self):
+        self._dispatch(True)
+
+    def do_HEAD(self):
+        self._dispatch(False)
+
+    def log_message(self, format, *args):
+        _logger.info("%s - %s", self.address_string(), format % args)
+
+    def _dispatch(self, body):
+        url = urllib.parse.urlsplit(self.path)
+        path = urllib.parse.unquote(url.path)
+        query = urllib.parse.parse_qs(url.query)
+        for pattern, method in self._routes:
+            match = pattern.match(path)
+            if match is not None:
+                try:
+                    getattr(self, method)(body, query, *match.groups())
+                except (ValueError, KeyError) as e:
+                    self._send_error(400, str(e))
+                return
+        self._send_error(404, "Not found")
+
+    def _send_error(self, code, message):
+        data = json.dumps({"error": message}).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def _not_modified(self, etag, mtime=None):
+        """Whether the client's copy is current, per the conditional headers"""
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            return "*" in tags or etag in tags or "W/" + etag in tags
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since is not None and mtime is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since.timestamp()
+        return False
+
+    def _send_json(self, body, value):
+        data = json.dumps(value, indent=2).encode("utf-8")
+        etag = '"{0}"'.format(hashlib.sha1(data).hexdigest())
+        if self._not_modified(etag):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def _get_storage(self, serial):
+        if int(serial) not in archive.get_devices(self.server.config_dir):
+            return None
+        path = os.path.join(self.server.config_dir, serial)
+        return storage.Storage(path, layout=archive.get_layout(path))
+
+    def _get_devices(self, body, query):
+        self._send_json(
+            body,
+            [
+                {"serial": serial, "files": "/devices/{0}/files".format(serial)}
+                for serial in archive.get_devices(self.server.config_dir)
+            ],
+        )
+
+    def _get_files(self, body, query, serial):
+        if self._get_storage(serial) is None:
+            return self._send_error(404, "No such device")
+        fit_types = [
+            int(value) if value.isdigit() else archive._directories[value]
+            for value in query.get("type", [])
+        ]
+        parameters = dict(
+            (key, query[key][-1])
+            for key in ("since", "until", "min_size", "max_size")
+            if key in query
+        )
+        rows = self.server.index.query(
+            [int(serial)],
+            fit_types,
+            parameters.get("since"),
+            index.next_day(parameters["until"]) if "until" in parameters else None,
+            int(parameters["min_size"]) if "min_size" in parameters else None,
+            int(parameters["max_size"]) if "max_size" in parameters else None,
+        )
+        self._send_json(
+            body,
+            [
+                {
+                    "name": name,
+                    "folder": folder,
+                    "fit_type": fit_type,
+                    "date": date,
+                    "size": size,
+                    "url": "/devices/{0}/files/{1}".format(
+                        serial, urllib.parse.quote(name)
+                    ),
+                }
+                for _, folder, name, fit_type, date, size in rows
+            ],
+        )
+
+    def _get_file(self, body, query, serial, name):
+        store = self._get_storage(serial)
+        if store is None or storage.Storage.get_name(name) != name:
+            return self._send_error(404, "No such file")
+        folder = next((f for f in archive._directories if store.exists(f, name)), None)
+        if folder is None:
+            return self._send_error(404, "No such file")
+
+        path = store.get_path(folder, name)
+        stat = os.stat(path)
+        coding = _get_coding(path)
+        encoded = coding is not None and _accepts(
+            self.headers.get("Accept-Encoding"), coding
+        )
+        # The stored and the decompressed file are different representations
+        etag = '"{0:x}-{1:x}{2}"'.format(
+            stat.st_mtime_ns,
+            stat.st_size,
+            "" if coding is None or encoded else "-identity",
+        )
+        if self._not_modified(etag, stat.st_mtime):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        with (
+            open(path, "rb") if coding is None or encoded else store.open(folder, name)
+        ) as fd:
+            size = fd.seek(0, os.SEEK_END)
+            header = self.headers.get("Range")
+            if_range = self.headers.get("If-Range")
+            if if_range is not None and if_range.strip() != etag:
+                header = None
+            try:
+                byte_range = parse_range(header, size)
+            except _RangeError:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */{0}".format(size))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            start, end = byte_range or (0, size)
+
+            self.send_response(200 if byte_range is None else 206)
+            self.send_header("Content-Type", "application/vnd.ant.fit")
+            self.send_header("Content-Length", str(end - start))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header(
+                "Last-Modified", email.utils.formatdate(stat.st_mtime, usegmt=True)
+            )
+            if coding is not None:
+                self.send_header("Vary", "Accept-Encoding")
+            if encoded:
+                self.send_header("Content-Encoding", coding)
+            if byte_range is not None:
+                self.send_header(
+                    "Content-Range", "bytes {0}-{1}/{2}".format(start, end - 1, size)
+                )
+            self.end_headers()
+            if body and end > start:
+                # Zero-copy with os.sendfile for stored files, plain reads and
+                # sends when decompressing. The size was found by seeking to
+                # the end, and sendfile only seeks for a non-zero offset.
+                fd.seek(start)
+                self.connection.sendfile(fd, start, end - start)
+
+
+# http.server.ThreadingHTTPServer is only available from Python 3.7
+class Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, config_dir, address=("127.0.0.1", 8610)):
+        self.config_dir = config_dir
+        self.index = index.Index(config_dir)
+        HTTPServer.__init__(self, address, Handler)
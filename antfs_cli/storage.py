@@ -0,0 +1,514 @@
+# Storage
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import bisect
+import contextlib
+import gzip
+import io
+import logging
+import os
+import re
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from . import utilities
+
+_logger = logging.getLogger()
+
+# Files are compressed in independent frames of this many bytes so that a
+# reader can seek without decompressing everything before the offset
+FRAME_SIZE = 64 * 1024
+
+
+_layouts = ["flat", "date"]
+
+_SHARD_NAME = re.compile(r"^(\d{4})-(\d{2})-")
+_SHARD_YEAR = re.compile(r"^\d{4}$")
+_SHARD_MONTH = re.compile(r"^\d{2}$")
+
+
+class StorageError(Exception):
+    def __init__(self, message):
+        super(StorageError, self).__init__(message)
+
+
+class _Gzip:
+    """Multi-member gzip, readable by any gzip tool
+
+    The first member carries a table of the compressed sizes of all members
+    in an extra field ("AF" subfield) which is used for random access.
+    """
+
+    suffix = ".gz"
+
+    _HEADER = struct.Struct("<BBBBIBB")
+    _TRAILER = struct.Struct("<II")
+
+    def _header(self, extra=b""):
+        if extra:
+            subfield = b"AF" + struct.pack("<H", len(extra)) + extra
+            return (
+                self._HEADER.pack(0x1F, 0x8B, 8, 0x04, 0, 0, 255)
+                + struct.pack("<H", len(subfield))
+                + subfield
+            )
+        return self._HEADER.pack(0x1F, 0x8B, 8, 0, 0, 0, 255)
+
+    def compress(self, data):
+        bodies, trailers = [], []
+        # Slices of a memoryview are not copied
+        view = memoryview(data)
+        for offset in range(0, len(data), FRAME_SIZE) or [0]:
+            chunk = view[offset : offset + FRAME_SIZE]
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+            bodies.append(compressor.compress(chunk) + compressor.flush())
+            trailers.append(
+                self._TRAILER.pack(zlib.crc32(chunk), len(chunk) & 0xFFFFFFFF)
+            )
+        table = struct.pack("<I", FRAME_SIZE) + b"".join(
+            struct.pack("<I", len(body)) for body in bodies
+        )
+        out = [self._header(table)]
+        for index, (body, trailer) in enumerate(zip(bodies, trailers)):
+            if index > 0:
+                out.append(self._header())
+            out.append(body)
+            out.append(trailer)
+        return b"".join(out)
+
+    def frames(self, fd):
+        """Return (offset, size, length) for each frame, or None"""
+        header = fd.read(12)
+        if len(header) < 12 or header[:2] != b"\x1f\x8b" or not header[3] & 0x04:
+            return None
+        (xlen,) = struct.unpack("<H", header[10:12])
+        extra = fd.read(xlen)
+        if extra[:2] != b"AF":
+            return None
+        (frame_size,) = struct.unpack("<I", extra[4:8])
+        sizes = struct.unpack("<{0}I".format((len(extra) - 8) // 4), extra[8:])
+        total = fd.seek(0, io.SEEK_END)
+
+        frames = []
+        offset = 12 + xlen
+        for size in sizes:
+            frames.append((offset, size, frame_size))
+            offset += size + self._TRAILER.size + self._HEADER.size
+        # The last frame is usually shorter, its length is in the trailer
+        fd.seek(total - 4)
+        (last,) = struct.unpack("<I", fd.read(4))
+        frames[-1] = frames[-1][:2] + (last,)
+        return frames
+
+    def decompress_frame(self, data):
+        return zlib.decompressobj(-15).decompress(data)
+
+    def decompress(self, fd):
+        return gzip.decompress(fd.read())
+
+
+class _Zstd:
+    """Zstandard frames followed by a seek table in the seekable format"""
+
+    suffix = ".zst"
+
+    _SKIPPABLE_MAGIC = 0x184D2A5E
+    _SEEKABLE_MAGIC = 0x8F92EAB1
+    _FOOTER = struct.Struct("<IBI")
+
+    def __init__(self):
+        if zstandard is None:
+            raise StorageError("zstd compression requires the zstandard module")
+
+    def compress(self, data):
+        compressor = zstandard.ZstdCompressor()
+        view = memoryview(data)
+        frames = [
+            (compressor.compress(view[offset : offset + FRAME_SIZE]), offset)
+            for offset in range(0, len(data), FRAME_SIZE) or [0]
+        ]
+        table = b"".join(
+            struct.pack("<II", len(frame), len(data[offset : offset + FRAME_SIZE]))
+            for frame, offset in frames
+        )
+        table += self._FOOTER.pack(len(frames), 0, self._SEEKABLE_MAGIC)
+        return b"".join(
+            [frame for frame, _ in frames]
+            + [struct.pack("<II", self._SKIPPABLE_MAGIC, len(table)), table]
+        )
+
+    def frames(self, fd):
+        """Return (offset, size, length) for each frame, or None"""
+        total = fd.seek(0, io.SEEK_END)
+        if total < self._FOOTER.size:
+            return None
+        fd.seek(total - self._FOOTER.size)
+        count, _, magic = self._FOOTER.unpack(fd.read(self._FOOTER.size))
+        if magic != self._SEEKABLE_MAGIC:
+            return None
+        fd.seek(total - self._FOOTER.size - count * 8)
+        entries = struct.unpack("<{0}I".format(count * 2), fd.read(count * 8))
+
+        frames = []
+        offset = 0
+        for size, length in zip(entries[::2], entries[1::2]):
+            frames.append((offset, size, length))
+            offset += size
+        return frames
+
+    def decompress_frame(self, data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    def decompress(self, fd):
+        return zstandard.ZstdDecompressor().stream_reader(fd).read()
+
+
+_codecs = {"gzip": _Gzip, "zstd": _Zstd}
+
+
+class _FrameReader(io.RawIOBase):
+    """Seekable reader over independently compressed frames"""
+
+    def __init__(self, fd, frames, codec):
+        self._fd = fd
+        self._frames = frames
+        self._codec = codec
+        self._starts = []
+        self._size = 0
+        for _, _, length in frames:
+            self._starts.append(self._size)
+            self._size += length
+        self._position = 0
+        self._cached = (None, b"")
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._position = max(0, offset)
+        return self._position
+
+    def _frame(self, index):
+        if self._cached[0] != index:
+            offset, size, _ = self._frames[index]
+            self._fd.seek(offset)
+            self._cached = (index, self._codec.decompress_frame(self._fd.read(size)))
+        return self._cached[1]
+
+    def readinto(self, buffer):
+        if self._position >= self._size:
+            return 0
+        index = bisect.bisect_right(self._starts, self._position) - 1
+        data = self._frame(index)
+        start = self._position - self._starts[index]
+        chunk = data[start : start + len(buffer)]
+        buffer[: len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+    def close(self):
+        self._fd.close()
+        super(_FrameReader, self).close()
+
+
+class Storage:
+    """FIT files of a device, stored plain or compressed
+
+    Files are addressed by folder and logical name (e.g. "activities" and
+    "2013-01-01_12-00-00_4_1.fit"), regardless of how they are stored. New
+    files are written using the configured codec (None, "gzip" or "zstd"),
+    existing files are read whichever way they were stored.
+
+    With the "date" layout files are sharded into year and month folders
+    ("activities/2013/01/..."), using the date the name starts with. Files
+    are found in either layout, so a device can be migrated a few files at a
+    time.
+    """
+
+    def __init__(self, path, codec=None, layout="flat"):
+        self._path = path
+        if codec is not None and codec not in _codecs:
+            raise StorageError("Unknown compression {0}".format(codec))
+        if layout not in _layouts:
+            raise StorageError("Unknown layout {0}".format(layout))
+        self._codec = _codecs[codec]() if codec is not None else None
+        self._layout = layout
+        # Held while looking up and then using or moving a file
+        self._lock = threading.RLock()
+
+    def get_codec(self):
+        return self._codec
+
+    def get_layout(self):
+        return self._layout
+
+    def _directories(self, folder, name):
+        """Folders the file may be in, where it should be first"""
+        flat = os.path.join(self._path, folder)
+        match = _SHARD_NAME.match(name)
+        if folder == "." or match is None:
+            return [flat]
+        sharded = os.path.join(flat, match.group(1), match.group(2))
+        if self._layout == "date":
+            return [sharded, flat]
+        return [flat, sharded]
+
+    def _find(self, folder, name):
+        for directory in self._directories(folder, name):
+            base = os.path.join(directory, name)
+            if os.path.exists(base):
+                return base, None
+            for codec in _codecs.values():
+                if os.path.exists(base + codec.suffix):
+                    return base + codec.suffix, codec()
+        return None, None
+
+    def _target(self, folder, name, codec):
+        directory = self._directories(folder, name)[0]
+        utilities.makedirs_if_not_exists(directory)
+        path = os.path.join(directory, name)
+        if codec is not None:
+            path += codec.suffix
+        return path
+
+    @staticmethod
+    def get_name(filename):
+        """Return the logical name of a stored file, or None"""
+        for codec in _codecs.values():
+            if filename.endswith(codec.suffix):
+                filename = filename[: -len(codec.suffix)]
+                break
+        if os.path.splitext(filename)[1].lower() == ".fit":
+            return filename
+        return None
+
+    def get_path(self, folder, name):
+        """Path of the stored file, or where a new file would be written"""
+        path, _ = self._find(folder, name)
+        if path is None:
+            path = os.path.join(self._directories(folder, name)[0], name)
+            if self._codec is not None:
+                path += self._codec.suffix
+        return path
+
+    def _walk(self, folder):
+        """Yield (directory, filename) of all files, flat ones first"""
+        flat = os.path.join(self._path, folder)
+        shards = []
+        if not os.path.isdir(flat):
+            # Folders are created as files are written, a missing one is empty
+            return
+        for filename in sorted(os.listdir(flat)):
+            path = os.path.join(flat, filename)
+            if os.path.isdir(path):
+                if folder != "." and _SHARD_YEAR.match(filename):
+                    shards.append(path)
+            else:
+                yield flat, filename
+        for year in shards:
+            for month in sorted(os.listdir(year)):
+                directory = os.path.join(year, month)
+                if _SHARD_MONTH.match(month) and os.path.isdir(directory):
+                    for filename in sorted(os.listdir(directory)):
+                        yield directory, filename
+
+    def list(self, folder):
+        names = set()
+        for _, filename in self._walk(folder):
+            name = self.get_name(filename)
+            if name is not None:
+                names.add(name)
+        return list(names)
+
+    def exists(self, folder, name):
+        return self._find(folder, name)[0] is not None
+
+    def write(self, folder, name, data, sync=False):
+        """Write data atomically, replacing any earlier copy of the file
+
+        With sync the data is flushed to disk before the file is replaced.
+        """
+        data = bytes(data)
+        if self._codec is not None:
+            data = self._codec.compress(data)
+        with self._lock:
+            previous, _ = self._find(folder, name)
+            path = self._target(folder, name, self._codec)
+            with open(path + ".tmp", "wb") as fd:
+                fd.write(data)
+                if sync:
+                    fd.flush()
+                    os.fsync(fd.fileno())
+            os.replace(path + ".tmp", path)
+            if previous is not None and previous != path:
+                os.remove(previous)
+        return path
+
+    def open(self, folder, name):
+        """Open the file for reading, decompressing on the fly"""
+        with self._lock:
+            path, codec = self._find(folder, name)
+            if path is None:
+                raise IOError("No such file {0}/{1}".format(folder, name))
+            fd = open(path, "rb")
+        if codec is None:
+            return fd
+        frames = codec.frames(fd)
+        if frames is None:
+            # Compressed elsewhere, without a seek table
+            fd.seek(0)
+            with fd:
+                return io.BytesIO(codec.decompress(fd))
+        return io.BufferedReader(_FrameReader(fd, frames, codec), FRAME_SIZE)
+
+    def read(self, folder, name):
+        with self.open(folder, name) as fd:
+            return fd.read()
+
+    def rename(self, folder, src, dst):
+        with self._lock:
+            path, codec = self._find(folder, src)
+            if path is None:
+                raise IOError("No such file {0}/{1}".format(folder, src))
+            target = self._target(folder, dst, codec)
+            os.rename(path, target)
+        return path, target
+
+    def remove(self, folder, name):
+        with self._lock:
+            path, _ = self._find(folder, name)
+            if path is not None:
+                os.remove(path)
+
+    def migrate(self, folders, limit=None, stop=None):
+        """Move files not yet in the configured layout, return the count
+
+        Every file is moved with a single rename and is found in both the
+        old and the new place, so the migration can be interrupted at any
+        time and continued later. At most limit files are moved, and it
+        stops early when the stop event is set.
+        """
+        moved = 0
+        for folder in folders:
+            for directory, filename in list(self._walk(folder)):
+                if stop is not None and stop.is_set():
+                    return moved
+                if limit is not None and moved >= limit:
+                    return moved
+                name = self.get_name(filename)
+                if name is None:
+                    continue
+                target = self._directories(folder, name)[0]
+                if directory == target:
+                    continue
+                with self._lock:
+                    if not os.path.exists(os.path.join(directory, filename)):
+                        continue
+                    utilities.makedirs_if_not_exists(target)
+                    os.rename(
+                        os.path.join(directory, filename),
+                        os.path.join(target, filename),
+                    )
+                moved += 1
+                # Tidy up shards emptied by a migration back to flat
+                if directory != os.path.join(self._path, folder):
+                    try:
+                        os.rmdir(directory)
+                        os.rmdir(os.path.dirname(directory))
+                    except OSError:
+                        pass
+        return moved
+
+    @contextlib.contextmanager
+    def local_path(self, folder, name):
+        """Path to a plain copy of the file, valid within the context
+
+        Plain files are used as is. Compressed files are decompressed into a
+        temporary directory, as <serial>/<folder>/<name> so that scripts can
+        still tell the device and type from the path, and removed afterwards.
+        The copy is kept out of the archive, where it would be found in
+        front of the compressed file.
+        """
+        path, codec = self._find(folder, name)
+        if codec is None:
+            yield path
+            return
+        directory = tempfile.mkdtemp(prefix="antfs-cli-")
+        try:
+            target = os.path.join(directory, os.path.basename(self._path), folder, name)
+            os.makedirs(os.path.dirname(target))
+            with self.open(folder, name) as src, open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            yield target
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+class Migration:
+    """Moves the files of a storage to its layout in a background thread"""
+
+    def __init__(self, storage, folders):
+        self._storage = storage
+        self._folders = folders
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="migration")
+        self._thread.daemon = True
+        self._moved = 0
+
+    def _run(self):
+        try:
+            self._moved = self._storage.migrate(self._folders, stop=self._stop)
+            _logger.debug("Migrated %d file(s)", self._moved)
+        except Exception:
+            _logger.exception("Layout migration failed")
+
+    def get_moved(self):
+        return self._moved
+
+    def start(self):
+        self._thread.start()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
@@ -30,13 +30,26 @@ import subprocess
 import sys
 
 
+def get_device_dir(filename):
+    # The device folder is above the activities folder, also when the file
+    # is in a year and month folder below it (the date layout)
+    directory = os.path.dirname(os.path.abspath(filename))
+    while os.path.basename(directory) != "activities":
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return os.path.dirname(os.path.dirname(os.path.abspath(filename)))
+        directory = parent
+    return os.path.dirname(directory)
+
+
 def main(action, filename, fit_type):
 
     # Only new downloads which are activities
     if action != "DOWNLOAD" or fit_type != "4":
         return 0
 
-    basedir = os.path.split(os.path.dirname(filename))[0]
+    # Given when the file is a temporary copy, e.g. of a compressed file
+    basedir = os.environ.get("ANTFS_CLI_DEVICE_DIR") or get_device_dir(filename)
     basefile = os.path.basename(filename)
 
     # Create directory
@@ -53,7 +66,7 @@ def main(action, filename, fit_type):
         process = subprocess.Popen(
             ["fittotcx", filename], stdout=subprocess.PIPE, stderr=subprocess.PIPE
         )
-        (data, _) = process.communicate()
+        data, _ = process.communicate()
     except OSError as e:
         print(
             "Could not run Convert to TCX - fittotcx",
@@ -38,7 +38,7 @@ setup(
     author="Gustav Tiger",
     author_email="gustav@tiger.name",
     packages=["antfs_cli"],
-    entry_points={"console_scripts": ["antfs-cli=antfs_cli.program:main"]},
+    entry_points={"console_scripts": ["antfs-cli=antfs_cli.commands:main"]},
     url="https://github.com/Tigge/antfs-cli",
     classifiers=[
         "Development Status :: 5 - Production/Stable",
@@ -56,6 +56,8 @@ setup(
     install_requires=["openant>=0.4"],
     extras_require={
         "upload": ["garmin-uploader"],
+        "zstd": ["zstandard"],
+        "parquet": ["pyarrow"],
     },
     test_suite="tests",
 )
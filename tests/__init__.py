@@ -20,4 +20,22 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
-__all__ = ["test_utilities"]
+__all__ = [
+    "test_archive",
+    "test_course",
+    "test_dedup",
+    "test_events",
+    "test_export",
+    "test_fit",
+    "test_fsck",
+    "test_index",
+    "test_migration",
+    "test_monitoring",
+    "test_pipeline",
+    "test_profiling",
+    "test_scripting",
+    "test_search",
+    "test_server",
+    "test_storage",
+    "test_utilities",
+]
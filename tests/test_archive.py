@@ -0,0 +1,84 @@
+# Ant
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from antfs_cli import archive
+
+
+class DeviceTest(unittest.TestCase):
+    """Test the device folder"""
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_create(self):
+        """Test that a new device gets its folders and profile version"""
+        device = archive.Device(self.basedir, 1234, "Forerunner")
+        self.assertEqual(device.get_path(), os.path.join(self.basedir, "1234"))
+        for folder in archive._directories:
+            self.assertTrue(os.path.isdir(os.path.join(device.get_path(), folder)))
+        self.assertEqual(device.get_profile_version(), archive.Device._PROFILE_VERSION)
+
+    def test_too_new(self):
+        """Test that a newer profile version is rejected"""
+        path = os.path.join(self.basedir, "1234")
+        os.mkdir(path)
+        with open(os.path.join(path, archive.Device._PROFILE_VERSION_FILE), "w") as f:
+            f.write(str(archive.Device._PROFILE_VERSION + 1))
+        self.assertRaises(
+            archive.Device.ProfileVersionException,
+            archive.Device,
+            self.basedir,
+            1234,
+            "Forerunner",
+        )
+
+    def test_compressed_storage(self):
+        """Test that the device stores files with the chosen compression"""
+        device = archive.Device(self.basedir, 1234, "Forerunner", "gzip")
+        path = device.get_storage().write("activities", "a.fit", b"data")
+        self.assertTrue(path.endswith(".fit.gz"))
+
+    def test_layout(self):
+        """Test that the layout is remembered"""
+        archive.Device(self.basedir, 1234, "Forerunner", layout="date")
+        device = archive.Device(self.basedir, 1234, "Forerunner")
+        self.assertEqual(device.get_layout(), "date")
+        self.assertEqual(device.get_storage().get_layout(), "date")
+
+    def test_get_serial(self):
+        """Test finding the device of a file from its path"""
+        device = archive.Device(self.basedir, 1234, "Forerunner", "gzip", "date")
+        store = device.get_storage()
+        name = "2013-01-01_10-00-00_4_1.fit"
+        path = store.write("activities", name, b"data")
+        self.assertEqual(archive.get_serial(path, "activities"), "1234")
+        with store.local_path("activities", name) as local:
+            self.assertEqual(archive.get_serial(local, "activities"), "1234")
+        self.assertIsNone(archive.get_serial(path, "courses"))
@@ -0,0 +1,193 @@
+# Ant
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from antfs_cli import archive
+from antfs_cli import course
+from antfs_cli import fit
+from antfs_cli import index
+
+GPX = b"""<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1">
+  <trk>
+    <name>Morning loop</name>
+    <trkseg>
+      <trkpt lat="57.700" lon="11.970"><ele>10</ele></trkpt>
+      <trkpt lat="57.701" lon="11.970"><ele>12</ele></trkpt>
+      <trkpt lat="57.702" lon="11.970"><ele>14</ele></trkpt>
+      <trkpt lat="57.702" lon="11.972"><ele>14</ele></trkpt>
+    </trkseg>
+  </trk>
+</gpx>
+"""
+
+TCX = b"""<?xml version="1.0" encoding="UTF-8"?>
+<TrainingCenterDatabase
+    xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">
+  <Courses>
+    <Course>
+      <Name>Commute</Name>
+      <Track>
+        <Trackpoint>
+          <Time>2013-01-01T10:00:00Z</Time>
+          <Position>
+            <LatitudeDegrees>57.700</LatitudeDegrees>
+            <LongitudeDegrees>11.970</LongitudeDegrees>
+          </Position>
+        </Trackpoint>
+        <Trackpoint>
+          <Time>2013-01-01T10:01:40Z</Time>
+          <Position>
+            <LatitudeDegrees>57.701</LatitudeDegrees>
+            <LongitudeDegrees>11.970</LongitudeDegrees>
+          </Position>
+        </Trackpoint>
+      </Track>
+    </Course>
+  </Courses>
+</TrainingCenterDatabase>
+"""
+
+
+class ParseTest(unittest.TestCase):
+    def test_gpx(self):
+        name, points = course.parse(GPX)
+        self.assertEqual(name, "Morning loop")
+        self.assertEqual(len(points), 4)
+        self.assertEqual((points[1].lat, points[1].altitude), (57.701, 12.0))
+
+    def test_tcx(self):
+        name, points = course.parse(TCX)
+        self.assertEqual(name, "Commute")
+        self.assertEqual(points[1].time - points[0].time, 100)
+
+    def test_invalid(self):
+        self.assertRaises(course.CourseError, course.parse, b"<kml/>")
+        self.assertRaises(course.CourseError, course.parse, b"not xml")
+        for point in [b'<trkpt lon="11.9"/>', b'<trkpt lat="x" lon="11.9"/>']:
+            data = b"<gpx>" + point * 2 + b"</gpx>"
+            self.assertRaises(course.CourseError, course.parse, data)
+        data = TCX.replace(b"<LatitudeDegrees>", b"<LatitudeDegrees>9", 1)
+        self.assertRaises(course.CourseError, course.parse, data)
+
+
+class SimplifyTest(unittest.TestCase):
+    def test_simplify(self):
+        """Test that points on a straight line are dropped, corners kept"""
+        _, points = course.parse(GPX)
+        simplified = course.simplify(points, 5.0)
+        self.assertEqual(simplified, [points[0], points[2], points[3]])
+        self.assertEqual(course.simplify(points, 0), points)
+
+
+class EncodeTest(unittest.TestCase):
+    def test_encode(self):
+        """Test the messages of an encoded course"""
+        _, points = course.parse(GPX)
+        data = course.encode("A very long course name", points, speed=3.6)
+        fit.check(io.BytesIO(data))
+        messages = list(fit.read_messages(io.BytesIO(data)))
+        self.assertEqual(
+            [number for number, _ in messages], [0, 31, 19, 21, 20, 20, 20, 21]
+        )
+        self.assertEqual(messages[0][1][0], 6)
+        self.assertEqual(messages[1][1][5], "A very long cou")
+        records = [message for number, message in messages if number == 20]
+        # Distance along all points, one second per meter
+        distance = records[-1][5] / 100.0
+        self.assertAlmostEqual(distance, 222.4 + 119.2, delta=1.0)
+        self.assertEqual(records[-1][253] - records[0][253], round(distance))
+        self.assertEqual(records[0][2], (10 + 500) * 5)
+        self.assertEqual(records[0][0], round(57.7 * 2**31 / 180))
+
+    def test_times(self):
+        """Test that times from the source are kept"""
+        _, points = course.parse(TCX)
+        messages = list(fit.read_messages(io.BytesIO(course.encode(None, points))))
+        records = [message for number, message in messages if number == 20]
+        self.assertEqual(records[0][253], 1357034400 - fit.EPOCH_OFFSET)
+        self.assertEqual(records[1][253] - records[0][253], 100)
+
+    def test_times_backwards(self):
+        """Test that times going backwards are replaced by times from speed"""
+        _, points = course.parse(TCX)
+        points[0].time, points[1].time = points[1].time, points[0].time
+        messages = list(fit.read_messages(io.BytesIO(course.encode(None, points))))
+        records = [message for number, message in messages if number == 20]
+        times = [record[253] for record in records]
+        self.assertEqual(times, sorted(times))
+
+    def test_bad_elevation(self):
+        """Test that an elevation that is not a number is left out"""
+        data = GPX.replace(b"<ele>10</ele>", b"<ele>high</ele>")
+        _, points = course.parse(data)
+        self.assertIsNone(points[0].altitude)
+        self.assertEqual(points[1].altitude, 12.0)
+
+    def test_parse_time(self):
+        self.assertEqual(course._parse_time("2013-01-01T10:00:00Z"), 1357034400)
+        self.assertEqual(course._parse_time("2013-01-01T12:00:00+02:00"), 1357034400)
+        self.assertEqual(course._parse_time("2013-01-01T09:30:00.5-0030"), 1357034400.5)
+        self.assertEqual(course._parse_time("2013-01-01T10:00:00"), 1357034400)
+        self.assertIsNone(course._parse_time("2013-02-30T10:00:00Z"))
+        self.assertIsNone(course._parse_time("yesterday"))
+        self.assertIsNone(course._parse_time(None))
+
+
+class CompilerTest(unittest.TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        archive.Device(self.basedir, 1234, "Forerunner")
+        self.source = os.path.join(self.basedir, "loop.gpx")
+        with open(self.source, "wb") as f:
+            f.write(GPX)
+        self.compiler = course.Compiler(self.basedir)
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_cache(self):
+        """Test that unchanged routes are taken from the cache"""
+        key, data, cached = self.compiler.compile(GPX)
+        self.assertFalse(cached)
+        self.assertEqual(self.compiler.compile(GPX), (key, data, True))
+        other = course.Compiler(self.basedir, tolerance=1.0)
+        self.assertFalse(other.compile(GPX)[2])
+
+    def test_add(self):
+        """Test adding a course to a device once"""
+        path = self.compiler.add(1234, self.source)
+        self.assertEqual(
+            path, os.path.join(self.basedir, "1234", "courses", "loop.fit")
+        )
+        rows = index.Index(self.basedir).query([1234])
+        self.assertEqual([row[1:3] for row in rows], [("courses", "loop.fit")])
+        os.remove(path)
+        self.assertIsNone(self.compiler.add(1234, self.source))
+        self.assertEqual(self.compiler.add(1234, self.source, force=True), path)
+        self.assertRaises(course.CourseError, self.compiler.add, 4321, self.source)
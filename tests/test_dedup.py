@@ -0,0 +1,87 @@
+# Ant
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from antfs_cli import archive
+from antfs_cli import dedup
+
+COURSE = "2013-01-02_10-00-00_6_2.fit"
+
+
+class DedupTest(unittest.TestCase):
+    """Test linking identical files of several devices"""
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.paths = []
+        for serial in (1, 2, 3):
+            store = archive.Device(self.basedir, serial, "Forerunner").get_storage()
+            store.write("courses", COURSE, b"course" * 100)
+            self.paths.append(store.get_path("courses", COURSE))
+        # Same size, other content
+        store.write("activities", "2013-01-01_10-00-00_4_1.fit", b"x" * 600)
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_hardlink(self):
+        """Test that duplicates become hardlinks and are linked only once"""
+        self.assertEqual(dedup.dedup(self.basedir), (2, 1200))
+        inodes = set(os.stat(path).st_ino for path in self.paths)
+        self.assertEqual(len(inodes), 1)
+        self.assertEqual(os.stat(self.paths[0]).st_nlink, 3)
+        self.assertEqual(dedup.dedup(self.basedir), (0, 0))
+
+    def test_dry_run(self):
+        self.assertEqual(dedup.dedup(self.basedir, dry_run=True), (2, 1200))
+        self.assertEqual(os.stat(self.paths[0]).st_nlink, 1)
+
+    def test_cache(self):
+        """Test that hashes are cached by inode"""
+        dedup.dedup(self.basedir, serials=[1, 2])
+        with open(os.path.join(self.basedir, "dedup.json")) as f:
+            entries = json.load(f)
+        stat = os.stat(self.paths[0])
+        key = "{0}:{1}".format(stat.st_dev, stat.st_ino)
+        self.assertEqual(entries[key][:2], [stat.st_mtime_ns, stat.st_size])
+
+    def test_reflink(self):
+        """Test reflinks, where the file system supports them"""
+        files, _ = dedup.dedup(self.basedir, method="reflink")
+        for path in self.paths:
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b"course" * 100)
+            self.assertFalse(os.path.exists(path + ".dedup"))
+        self.assertEqual(os.stat(self.paths[0]).st_nlink, 1)
+        self.assertIn(files, (0, 2))
+
+    def test_no_config_dir(self):
+        """Test that the cache can be saved before the first sync"""
+        missing = os.path.join(self.basedir, "missing")
+        self.assertEqual(dedup.dedup(missing), (0, 0))
+        self.assertTrue(os.path.exists(os.path.join(missing, "dedup.json")))
@@ -0,0 +1,71 @@
+# Ant
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import io
+import json
+import unittest
+
+from antfs_cli import events
+
+
+class JsonEventsTest(unittest.TestCase):
+    """Test the newline delimited JSON event stream"""
+
+    def test_one_object_per_line(self):
+        """Test that every event is written as a single JSON line"""
+        stream = io.StringIO()
+        output = events.JsonEvents(stream)
+        output.emit("search")
+        output.emit("directory", downloading=3, uploading=None)
+
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(json.loads(lines[0])["event"], "search")
+        directory = json.loads(lines[1])
+        self.assertEqual(directory["event"], "directory")
+        self.assertEqual(directory["downloading"], 3)
+        self.assertIn("time", directory)
+
+
+class TextEventsTest(unittest.TestCase):
+    """Test the human readable output"""
+
+    def test_authentication(self):
+        """Test that authentication is printed on one line"""
+        stream = io.StringIO()
+        output = events.TextEvents(stream)
+        output.emit("auth_start", method="passkey")
+        output.emit("auth_result", method="passkey", ok=True)
+        self.assertEqual(stream.getvalue(), " - Passkey: OK\n")
+
+    def test_directory(self):
+        """Test the download summary without uploading"""
+        stream = io.StringIO()
+        output = events.TextEvents(stream)
+        output.emit("directory", local=1, remote=2, downloading=1, uploading=None)
+        self.assertEqual(stream.getvalue(), "Downloading 1 file(s)\n")
+
+    def test_unknown_event(self):
+        """Test that events without a text representation are ignored"""
+        stream = io.StringIO()
+        events.TextEvents(stream).emit("summary", downloaded=0)
+        self.assertEqual(stream.getvalue(), "")
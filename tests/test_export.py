@@ -0,0 +1,109 @@
+# Ant
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from antfs_cli import archive
+from antfs_cli import export
+from antfs_cli import fit
+from tests.test_fit import definition, make_fit, message
+
+ACTIVITY = "2013-01-01_10-00-00_4_1.fit"
+
+
+def make_activity(count=3):
+    """An activity with count records, the last without heart rate"""
+    data = definition(0, 20, [(253, 4, 0x86), (3, 1, 0x02), (0, 4, 0x85)])
+    for i in range(count):
+        heart_rate = 0xFF if i == count - 1 else 120 + i
+        data += message(0, "<IBi", 1000 + i, heart_rate, -5000 + i)
+    # A lap message, which is not exported
+    data += definition(1, 19, [(253, 4, 0x86)]) + message(1, "<I", 2000)
+    return make_fit(data)
+
+
+class DecodeTest(unittest.TestCase):
+    """Test decoding records into columns"""
+
+    def test_decode(self):
+        """Test that missing values are stored as invalid"""
+        columns = export.decode_records(io.BytesIO(make_activity()))
+        self.assertEqual(
+            list(columns["timestamp"]),
+            [1000 + fit.EPOCH_OFFSET, 1001 + fit.EPOCH_OFFSET, 1002 + fit.EPOCH_OFFSET],
+        )
+        self.assertEqual(list(columns["heart_rate"]), [120, 121, 0xFF])
+        self.assertEqual(list(columns["position_lat"]), [-5000, -4999, -4998])
+        self.assertEqual(list(columns["power"]), [0xFFFF] * 3)
+        self.assertEqual(columns["position_lat"].typecode, "i")
+
+
+class ExporterTest(unittest.TestCase):
+    """Test exporting the archive"""
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        device = archive.Device(self.basedir, 1234, "Forerunner", "gzip")
+        self.store = device.get_storage()
+        self.store.write("activities", ACTIVITY, make_activity())
+        self.exporter = export.Exporter(self.basedir)
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_update(self):
+        """Test that only new or changed activities are exported"""
+        partitions = self.exporter.update()
+        self.assertEqual(partitions, [self.exporter.get_partition(1234, ACTIVITY)])
+        self.assertTrue(
+            os.path.exists(os.path.join(self.exporter.get_directory(), "schema.json"))
+        )
+        columns = export.read_npz(partitions[0])
+        self.assertEqual(list(columns["heart_rate"]), [120, 121, 0xFF])
+        self.assertEqual(self.exporter.update(), [])
+
+    def test_numpy(self):
+        """Test that partitions can be loaded with numpy"""
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy not installed")
+        (partition,) = self.exporter.update()
+        columns = numpy.load(partition)
+        self.assertEqual(columns["heart_rate"].dtype, numpy.uint8)
+        self.assertEqual(list(columns["position_lat"]), [-5000, -4999, -4998])
+
+    def test_hook(self):
+        """Test exporting from a download hook"""
+        with self.store.local_path("activities", ACTIVITY) as path:
+            self.exporter.on_action("DOWNLOAD", path, archive.FileType.ACTIVITY)
+        self.assertTrue(os.path.exists(self.exporter.get_partition("1234", ACTIVITY)))
+
+    def test_corrupt(self):
+        """Test that corrupt activities are skipped"""
+        self.store.write("activities", ACTIVITY, make_activity()[:20])
+        self.assertEqual(self.exporter.update(), [])
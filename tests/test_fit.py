@@ -0,0 +1,181 @@
+# Ant
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import io
+import struct
+import unittest
+
+from antfs_cli import fit
+
+
+def make_fit(data=b"\x40\x00\x00\x00\x00\x01\x00\x01\x02\x84\x00\x04", header_crc=True):
+    """Build a FIT file around the given record data"""
+    header = struct.pack("<BBHI4s", 14, 0x10, 2014, len(data), b".FIT")
+    header += struct.pack("<H", fit.crc(header) if header_crc else 0)
+    return header + data + struct.pack("<H", fit.crc(header + data))
+
+
+def definition(local, number, fields, big_endian=False):
+    """A definition message, fields are (number, size, base type)"""
+    endian = ">" if big_endian else "<"
+    data = struct.pack(
+        endian + "BBBHB", 0x40 | local, 0, big_endian, number, len(fields)
+    )
+    return data + b"".join(struct.pack("BBB", *field) for field in fields)
+
+
+def message(local, fmt, *values):
+    """A data message"""
+    return struct.pack("<B", local) + struct.pack(fmt, *values)
+
+
+class CrcTest(unittest.TestCase):
+    """Test the FIT CRC"""
+
+    def test_check_value(self):
+        """Test the standard CRC-16 check value"""
+        self.assertEqual(fit.crc(b"123456789"), 0xBB3D)
+
+    def test_incremental(self):
+        """Test that the CRC can be computed in parts"""
+        self.assertEqual(fit.crc(b"6789", fit.crc(b"12345")), 0xBB3D)
+
+
+class CheckTest(unittest.TestCase):
+    """Test checking FIT files"""
+
+    def test_good(self):
+        """Test that a good file passes"""
+        headers = fit.check(io.BytesIO(make_fit()))
+        self.assertEqual(len(headers), 1)
+        self.assertEqual(headers[0].profile_version, 2014)
+
+    def test_chunks(self):
+        """Test that a file read in small chunks passes"""
+        fit.check(io.BytesIO(make_fit(bytes(range(200)))), chunk_size=7)
+
+    def test_no_header_crc(self):
+        """Test that a zero header CRC is accepted"""
+        fit.check(io.BytesIO(make_fit(header_crc=False)))
+
+    def test_chained(self):
+        """Test that chained FIT files are all checked"""
+        self.assertEqual(len(fit.check(io.BytesIO(make_fit() + make_fit()))), 2)
+
+    def test_bad_crc(self):
+        """Test that corrupt data is detected"""
+        data = bytearray(make_fit())
+        data[16] ^= 0xFF
+        self.assertRaises(fit.FitError, fit.check, io.BytesIO(bytes(data)))
+
+    def test_truncated(self):
+        """Test that truncated files are detected"""
+        data = make_fit()
+        for length in [0, 5, 14, 20, len(data) - 1]:
+            self.assertRaises(fit.FitError, fit.check, io.BytesIO(data[:length]))
+
+    def test_not_fit(self):
+        """Test that other files are detected"""
+        self.assertRaises(fit.FitError, fit.check, io.BytesIO(b"\x0e" + b"x" * 40))
+
+
+class ReadMessagesTest(unittest.TestCase):
+    """Test decoding FIT messages"""
+
+    def test_record(self):
+        """Test decoding data messages with invalid values and arrays"""
+        data = definition(
+            0, 20, [(253, 4, 0x86), (3, 1, 0x02), (2, 2, 0x84), (9, 4, 0x84)]
+        )
+        data += message(0, "<IBHHH", 1000, 150, 2600, 1, 0xFFFF)
+        data += message(0, "<IBHHH", 1001, 0xFF, 2610, 2, 3)
+        messages = list(fit.read_messages(io.BytesIO(make_fit(data))))
+        self.assertEqual(
+            messages,
+            [
+                (20, {253: 1000, 3: 150, 2: 2600, 9: (1, None)}),
+                (20, {253: 1001, 3: None, 2: 2610, 9: (2, 3)}),
+            ],
+        )
+
+    def test_filter(self):
+        """Test that only the requested messages are decoded"""
+        data = definition(0, 0, [(0, 1, 0x00)]) + message(0, "<B", 4)
+        data += definition(1, 20, [(3, 1, 0x02)]) + message(1, "<B", 99)
+        messages = list(fit.read_messages(io.BytesIO(make_fit(data)), [20]))
+        self.assertEqual(messages, [(20, {3: 99})])
+
+    def test_big_endian_and_string(self):
+        """Test big endian fields and strings"""
+        data = definition(2, 1, [(0, 2, 0x84), (1, 8, 0x07)], big_endian=True)
+        data += struct.pack(">BH8s", 2, 513, b"abc\0\0\0\0\0")
+        messages = list(fit.read_messages(io.BytesIO(make_fit(data))))
+        self.assertEqual(messages, [(1, {0: 513, 1: "abc"})])
+
+    def test_compressed_timestamp(self):
+        """Test compressed timestamp headers"""
+        data = definition(0, 20, [(253, 4, 0x86), (3, 1, 0x02)])
+        data += message(0, "<IB", 1000, 100)
+        data += definition(1, 20, [(3, 1, 0x02)])
+        # The low five bits of 1000 are 8, so 10 is 2 seconds later and 2
+        # wraps around to 24 seconds after that
+        data += struct.pack("<BB", 0x80 | (1 << 5) | 10, 101)
+        data += struct.pack("<BB", 0x80 | (1 << 5) | 2, 102)
+        messages = list(fit.read_messages(io.BytesIO(make_fit(data))))
+        self.assertEqual(
+            [m[253] for _, m in messages],
+            [1000, 1002, 1026],
+        )
+
+    def test_developer_fields(self):
+        """Test that developer fields are skipped"""
+        data = struct.pack("<BBBHB", 0x60, 0, 0, 20, 1) + struct.pack("BBB", 3, 1, 2)
+        data += struct.pack("<BBBB", 1, 0, 4, 0)
+        data += message(0, "<B4x", 60)
+        data += message(0, "<B4x", 61)
+        messages = list(fit.read_messages(io.BytesIO(make_fit(data))))
+        self.assertEqual(messages, [(20, {3: 60}), (20, {3: 61})])
+
+    def test_undefined(self):
+        """Test that a message without definition is an error"""
+        data = make_fit(message(3, "<B", 1))
+        self.assertRaises(fit.FitError, list, fit.read_messages(io.BytesIO(data)))
+
+
+class EncoderTest(unittest.TestCase):
+    """Test writing FIT files"""
+
+    def test_round_trip(self):
+        """Test that encoded messages decode to the same values"""
+        encoder = fit.Encoder()
+        encoder.message(31, [(5, 0x07, "Route")])
+        for i in range(20):
+            # A new definition for each, reusing local message numbers
+            encoder.message(100 + i, [(0, 0x84, i), (1, 0x85, -i)])
+        encoder.message(31, [(5, 0x07, "Back")])
+        data = encoder.get_data()
+        fit.check(io.BytesIO(data))
+        messages = list(fit.read_messages(io.BytesIO(data)))
+        self.assertEqual(messages[0], (31, {5: "Route"}))
+        self.assertEqual(messages[20], (119, {0: 19, 1: -19}))
+        self.assertEqual(messages[21], (31, {5: "Back"}))
@@ -0,0 +1,91 @@
+# Ant
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from antfs_cli import archive
+from antfs_cli import fsck
+from antfs_cli import index
+from tests.test_fit import make_fit
+
+
+class FsckTest(unittest.TestCase):
+    """Test checking the archive"""
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        device = archive.Device(self.basedir, 1234, "Forerunner")
+        self.store = device.get_storage()
+        self.good = self.store.write("activities", "good.fit", make_fit())
+        self.bad = self.store.write("activities", "bad.fit", make_fit()[:-3])
+        compressed = archive.Device(self.basedir, 5678, "Forerunner", "gzip")
+        self.compressed = compressed.get_storage()
+        self.compressed.write("activities", "good.fit", make_fit())
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_fsck(self):
+        """Test that bad files are found and hidden from the local scan"""
+        checked = []
+        bad = fsck.fsck(self.basedir, jobs=2, callback=lambda *a: checked.append(a))
+        self.assertEqual([path for path, _ in bad], [self.bad])
+        self.assertEqual(len(checked), 3)
+        self.assertEqual(self.store.list("activities"), ["good.fit"])
+        self.assertTrue(os.path.exists(self.bad + fsck.CORRUPT_SUFFIX))
+
+    def test_no_repair(self):
+        """Test that files are left alone without repair"""
+        fsck.fsck(self.basedir, [1234], jobs=1, repair=False)
+        self.assertEqual(len(self.store.list("activities")), 2)
+
+    def test_cache(self):
+        """Test that unchanged files are not checked again"""
+        fsck.fsck(self.basedir, jobs=1, repair=False)
+        cache = fsck.Cache(os.path.join(self.basedir, "fsck.json"))
+        self.assertEqual(cache.get(self.good, os.stat(self.good)), (True, None))
+
+        # Fix the bad file, the changed file is checked again
+        self.store.write("activities", "bad.fit", make_fit())
+        self.assertEqual(fsck.fsck(self.basedir, jobs=1), [])
+
+    def test_damaged_compressed(self):
+        """Test that a damaged compressed file is reported, not raised"""
+        path = self.compressed.write("activities", "damaged.fit", make_fit() * 8)
+        with open(path, "r+b") as f:
+            f.seek(20)
+            f.write(b"\xff" * 16)
+        bad = fsck.fsck(self.basedir, [5678], jobs=1)
+        self.assertEqual([p for p, _ in bad], [path])
+        self.assertEqual(self.compressed.list("activities"), ["good.fit"])
+
+    def test_index(self):
+        """Test that repaired files are removed from the index"""
+        files = index.Index(self.basedir)
+        files.update()
+        fsck.fsck(self.basedir, jobs=1)
+        names = [row[2] for row in files.query([1234])]
+        self.assertEqual(names, ["good.fit"])
@@ -0,0 +1,121 @@
+# Ant
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from antfs_cli import archive
+from antfs_cli import index
+
+
+class GetDateTest(unittest.TestCase):
+    def test_get_date(self):
+        self.assertEqual(
+            index.get_date("2013-01-02_10-20-30_4_1.fit"), "2013-01-02 10:20:30"
+        )
+        self.assertIsNone(index.get_date("device.fit"))
+
+
+class IndexTest(unittest.TestCase):
+    """Test indexing and querying the archive"""
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.store = archive.Device(self.basedir, 1234, "Forerunner").get_storage()
+        self.store.write("activities", "2013-01-01_10-00-00_4_1.fit", b"a" * 10)
+        self.store.write("activities", "2013-02-01_10-00-00_4_2.fit", b"a" * 100)
+        self.store.write("monitoring_b", "2013-01-15_00-00-00_32_3.fit", b"m")
+        other = archive.Device(self.basedir, 5678, "Forerunner", layout="date")
+        other.get_storage().write("activities", "2013-01-20_08-00-00_4_1.fit", b"b")
+        self.index = index.Index(self.basedir)
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def names(self, **kwargs):
+        return [row[2] for row in self.index.query(**kwargs)]
+
+    def test_query(self):
+        """Test that results are ordered by date and filtered"""
+        self.assertEqual(
+            self.names(fit_types=[archive.FileType.ACTIVITY]),
+            [
+                "2013-01-01_10-00-00_4_1.fit",
+                "2013-01-20_08-00-00_4_1.fit",
+                "2013-02-01_10-00-00_4_2.fit",
+            ],
+        )
+        self.assertEqual(
+            self.names(serials=[1234], start="2013-01-10", end="2013-02-01"),
+            ["2013-01-15_00-00-00_32_3.fit"],
+        )
+        self.assertEqual(self.names(min_size=50), ["2013-02-01_10-00-00_4_2.fit"])
+        (row,) = self.index.query(serials=[5678])
+        self.assertEqual(
+            row,
+            (
+                5678,
+                "activities",
+                "2013-01-20_08-00-00_4_1.fit",
+                archive.FileType.ACTIVITY,
+                "2013-01-20 08:00:00",
+                1,
+            ),
+        )
+
+    def test_add(self):
+        """Test that downloaded files are added once a device is indexed"""
+        self.index.update()
+        self.store.write("activities", "2013-03-01_10-00-00_4_3.fit", b"c")
+        self.index.add(1234, "activities", "2013-03-01_10-00-00_4_3.fit")
+        self.assertEqual(
+            self.names(start="2013-03-01"), ["2013-03-01_10-00-00_4_3.fit"]
+        )
+        self.store.rename(
+            "activities",
+            "2013-03-01_10-00-00_4_3.fit",
+            "2013-03-02_10-00-00_4_3.fit",
+        )
+        self.index.rename(
+            1234,
+            "activities",
+            "2013-03-01_10-00-00_4_3.fit",
+            "2013-03-02_10-00-00_4_3.fit",
+        )
+        self.assertEqual(
+            self.names(start="2013-03-01"), ["2013-03-02_10-00-00_4_3.fit"]
+        )
+
+    def test_rescan(self):
+        """Test that an upgraded device folder is scanned again"""
+        self.index.update()
+        self.store.write("activities", "2013-03-01_10-00-00_4_3.fit", b"c")
+        self.assertEqual(self.names(start="2013-03-01"), [])
+        path = os.path.join(self.basedir, "1234", "profile_version")
+        with open(path, "w") as f:
+            f.write("99")
+        self.assertEqual(
+            self.names(start="2013-03-01"), ["2013-03-01_10-00-00_4_3.fit"]
+        )
@@ -0,0 +1,175 @@
+# Ant
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from antfs_cli import archive
+from antfs_cli import migration
+
+
+class MigrationTest(unittest.TestCase):
+    """Test profile migrations"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.version_file = os.path.join(self.path, "profile_version")
+        with open(os.path.join(self.path, "a.fit"), "w") as f:
+            f.write("a")
+
+        @migration.migration(100, "move a to b")
+        def move(transaction, path):
+            transaction.makedirs(os.path.join(path, "b"))
+            transaction.rename(
+                os.path.join(path, "a.fit"), os.path.join(path, "b", "a.fit")
+            )
+
+        @migration.migration(101, "fail")
+        def fail(transaction, path):
+            transaction.rename(
+                os.path.join(path, "b", "a.fit"), os.path.join(path, "c.fit")
+            )
+            raise ValueError("broken")
+
+    def tearDown(self):
+        del migration._migrations[100]
+        del migration._migrations[101]
+        shutil.rmtree(self.path)
+
+    def test_upgrade(self):
+        """Test a single upgrade step"""
+        steps = migration.upgrade(self.path, 100, 101, "profile_version")
+        self.assertEqual([(v, d) for v, d, _ in steps], [(100, "move a to b")])
+        self.assertTrue(os.path.exists(os.path.join(self.path, "b", "a.fit")))
+        with open(self.version_file) as f:
+            self.assertEqual(f.read(), "101")
+        self.assertEqual(sorted(os.listdir(self.path)), ["b", "profile_version"])
+
+    def test_dry_run(self):
+        """Test that a dry run plans but does not change anything"""
+        steps = migration.upgrade(self.path, 100, 101, "profile_version", True)
+        self.assertEqual(
+            [o["op"] for o in steps[0][2]], ["makedirs", "rename", "write"]
+        )
+        self.assertEqual(os.listdir(self.path), ["a.fit"])
+
+    def test_rollback(self):
+        """Test that a failing step is rolled back to the last good version"""
+        self.assertRaises(
+            migration.MigrationError,
+            migration.upgrade,
+            self.path,
+            100,
+            102,
+            "profile_version",
+        )
+        self.assertTrue(os.path.exists(os.path.join(self.path, "b", "a.fit")))
+        with open(self.version_file) as f:
+            self.assertEqual(f.read(), "101")
+        self.assertFalse(migration.recover(self.path))
+
+    def test_commit_crash(self):
+        """Test a crash while committing a step that replaced a file"""
+        with open(self.version_file, "w") as f:
+            f.write("100")
+        remove = os.remove
+
+        def crash(path):
+            remove(path)
+            raise KeyboardInterrupt()
+
+        with mock.patch("os.remove", crash):
+            self.assertRaises(
+                KeyboardInterrupt,
+                migration.upgrade,
+                self.path,
+                100,
+                101,
+                "profile_version",
+            )
+        migration.recover(self.path)
+        # Either both the layout and the version are new or both are old
+        with open(self.version_file) as f:
+            upgraded = f.read() == "101"
+        self.assertEqual(
+            os.path.exists(os.path.join(self.path, "b", "a.fit")), upgraded
+        )
+
+    def test_missing_step(self):
+        """Test that an unknown version can not be upgraded"""
+        self.assertRaises(
+            migration.MigrationError, migration.upgrade, self.path, 99, 101, "v"
+        )
+
+    def test_recover(self):
+        """Test rolling back a step interrupted by a crash"""
+        os.mkdir(os.path.join(self.path, "b"))
+        os.rename(
+            os.path.join(self.path, "a.fit"), os.path.join(self.path, "b", "a.fit")
+        )
+        with open(os.path.join(self.path, "migration.journal"), "w") as f:
+            f.write(
+                json.dumps({"op": "makedirs", "path": os.path.join(self.path, "b")})
+            )
+            f.write("\n")
+            f.write(
+                json.dumps(
+                    {
+                        "op": "rename",
+                        "src": os.path.join(self.path, "a.fit"),
+                        "dst": os.path.join(self.path, "b", "a.fit"),
+                    }
+                )
+            )
+            f.write('\n{"op": "wri')
+        self.assertTrue(migration.recover(self.path))
+        self.assertEqual(os.listdir(self.path), ["a.fit"])
+
+
+class DeviceUpgradeTest(unittest.TestCase):
+    """Test upgrading device folders"""
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.path = os.path.join(self.basedir, "1234")
+        os.mkdir(self.path)
+        for name in ["2013-01-01_10-00-00_4_1.fit", "2013-01-01_10-00-00_1_1.fit"]:
+            open(os.path.join(self.path, name), "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_version_0(self):
+        """Test that files of an unversioned folder are sorted by type"""
+        device = archive.Device(self.basedir, 1234, "Forerunner")
+        self.assertEqual(device.get_profile_version(), archive.Device._PROFILE_VERSION)
+        self.assertEqual(
+            device.get_storage().list("activities"), ["2013-01-01_10-00-00_4_1.fit"]
+        )
+        self.assertEqual(
+            device.get_storage().list("."), ["2013-01-01_10-00-00_1_1.fit"]
+        )
@@ -0,0 +1,138 @@
+# Ant
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from antfs_cli import archive
+from antfs_cli import fit
+from antfs_cli import monitoring
+from tests.test_fit import definition, make_fit, message
+
+MONITORING = "2013-01-01_23-59-00_32_1.fit"
+
+# 2013-01-01 23:59:00 UTC
+START = 1357084740
+
+
+def make_monitoring(start=START, count=4, heart_rate=60):
+    """A monitoring file with a sample and count heart rate samples a minute
+    apart, using 16 bit timestamps"""
+    timestamp = start - fit.EPOCH_OFFSET
+    data = definition(0, 103, [(253, 4, 0x86)]) + message(0, "<I", timestamp)
+    data += definition(1, 55, [(253, 4, 0x86), (5, 1, 0x00), (3, 4, 0x86)])
+    data += message(1, "<IBI", timestamp, 6, 1000)
+    data += definition(2, 55, [(26, 2, 0x84), (27, 1, 0x02)])
+    for i in range(count):
+        data += message(2, "<HB", (timestamp + 60 * (i + 1)) & 0xFFFF, heart_rate)
+    return make_fit(data)
+
+
+class DecodeTest(unittest.TestCase):
+    """Test decoding monitoring samples"""
+
+    def test_decode(self):
+        """Test that 16 bit timestamps are expanded"""
+        samples = monitoring.decode_samples(io.BytesIO(make_monitoring(count=2)))
+        missing = (0xFFFFFFFF, 0xFFFFFFFF, 0xFFFF, 0xFFFFFFFF)
+        self.assertEqual(
+            samples,
+            [
+                (START, 6, 0xFF, 0xFF, 1000) + missing[1:],
+                (START + 60, 0xFF, 0xFF, 60) + missing,
+                (START + 120, 0xFF, 0xFF, 60) + missing,
+            ],
+        )
+
+    def test_rollover(self):
+        """Test 16 bit timestamps wrapping around"""
+        start = START - (START - fit.EPOCH_OFFSET) % 0x10000 + 0x10000 - 60
+        samples = monitoring.decode_samples(io.BytesIO(make_monitoring(start, 2)))
+        self.assertEqual([s[0] for s in samples], [start, start + 60, start + 120])
+
+    def test_out_of_range(self):
+        """Test that values not fitting a column are stored as invalid"""
+        timestamp = START - fit.EPOCH_OFFSET
+        data = definition(0, 55, [(253, 4, 0x86), (27, 2, 0x84), (19, 4, 0x85)])
+        data += message(0, "<IHi", timestamp, 300, -5)
+        (sample,) = monitoring.decode_samples(io.BytesIO(make_fit(data)))
+        self.assertEqual(sample[3], 0xFF)
+        self.assertEqual(sample[6], 0xFFFF)
+        self.assertEqual(sample[7], 0xFFFFFFFF)
+
+
+class MonitoringStoreTest(unittest.TestCase):
+    """Test the daily time series"""
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        device = archive.Device(self.basedir, 1234, "Forerunner")
+        self.store = device.get_storage()
+        self.store.write("monitoring_b", MONITORING, make_monitoring())
+        self.monitoring = monitoring.MonitoringStore(self.basedir)
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_update(self):
+        """Test that samples are split by day and files merged only once"""
+        self.assertEqual(self.monitoring.update(), 5)
+        directory = os.path.join(self.monitoring.get_directory(), "1234")
+        self.assertTrue(os.path.exists(os.path.join(directory, "2013-01-01.bin")))
+        self.assertTrue(os.path.exists(os.path.join(directory, "2013-01-02.bin")))
+        self.assertEqual(self.monitoring.update(), 0)
+
+    def test_overlap(self):
+        """Test that overlapping files replace samples instead of adding"""
+        self.monitoring.update()
+        self.store.write(
+            "monitoring_b",
+            "2013-01-02_00-01-00_32_2.fit",
+            make_monitoring(START + 120, 4, 70),
+        )
+        # New: the activity sample at START + 120 and heart rate up to + 360
+        self.assertEqual(self.monitoring.update(), 3)
+        samples = self.monitoring.query(1234, START, START + 3600)
+        heart_rate = [(s[0], s[3]) for s in samples if s[1] == 0xFF]
+        self.assertEqual(
+            heart_rate,
+            [(START + 60, 60), (START + 120, 60)]
+            + [(START + 60 * i, 70) for i in range(3, 7)],
+        )
+
+    def test_query(self):
+        """Test range queries within and across days"""
+        self.monitoring.update()
+        samples = self.monitoring.query(1234, START + 60, START + 180)
+        self.assertEqual([s[0] for s in samples], [START + 60, START + 120])
+        self.assertEqual(self.monitoring.query(1234, START + 300, START + 900), [])
+        self.assertEqual(self.monitoring.query(4321, START, START + 900), [])
+
+    def test_hook(self):
+        """Test merging from a download hook"""
+        with self.store.local_path("monitoring_b", MONITORING) as path:
+            self.monitoring.on_action("DOWNLOAD", path, archive.FileType.MONITORING_B)
+        self.assertEqual(len(self.monitoring.query(1234, START, START + 900)), 5)
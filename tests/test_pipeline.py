@@ -0,0 +1,112 @@
+# Ant
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from antfs_cli import fsck
+from antfs_cli import pipeline
+from antfs_cli import storage
+from tests.test_fit import make_fit
+
+ACTIVITY = "2013-01-01_10-00-00_4_1.fit"
+
+
+class PipelineTest(unittest.TestCase):
+    """Test storing downloads in the background"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = storage.Storage(self.path)
+        self.pipeline = pipeline.Pipeline(self.store, depth=1)
+        self.stored = []
+        self.pipeline.on_stored = lambda *args: self.stored.append(args[:5])
+        self.pipeline.start()
+
+    def tearDown(self):
+        self.pipeline.close()
+        shutil.rmtree(self.path)
+
+    def test_store(self):
+        """Test that files are stored in order and reported"""
+        names = ["2013-01-0{0}_10-00-00_4_1.fit".format(i) for i in range(1, 6)]
+        for name in names:
+            self.pipeline.submit("activities", name, make_fit(), 4)
+        self.pipeline.join()
+        self.assertEqual([s[1] for s in self.stored], names)
+        self.assertEqual(
+            self.stored[0],
+            (
+                "activities",
+                names[0],
+                4,
+                os.path.join(self.path, "activities", names[0]),
+                None,
+            ),
+        )
+        self.assertEqual(self.store.read("activities", names[0]), make_fit())
+
+    def test_bad_crc(self):
+        """Test that files with a bad CRC are kept aside"""
+        data = bytearray(make_fit())
+        data[-1] ^= 0xFF
+        self.pipeline.submit("activities", ACTIVITY, data, 4)
+        self.pipeline.close()
+        ((_, name, _, path, error),) = self.stored
+        self.assertEqual(name, ACTIVITY)
+        self.assertEqual(error, "CRC mismatch")
+        self.assertTrue(path.endswith(ACTIVITY + fsck.CORRUPT_SUFFIX))
+        self.assertEqual(self.store.list("activities"), [])
+
+    def test_bad_crc_compressed(self):
+        """Test that bad compressed files are named as fsck names them"""
+        store = storage.Storage(self.path, "gzip")
+        stage = pipeline.Pipeline(store)
+        stage.on_stored = lambda *args: self.stored.append(args[:5])
+        stage.start()
+        stage.submit("activities", ACTIVITY, make_fit()[:-1], 4)
+        stage.close()
+        path = self.stored[0][3]
+        self.assertEqual(os.path.basename(path), ACTIVITY + ".gz" + fsck.CORRUPT_SUFFIX)
+        self.assertEqual(os.listdir(os.path.dirname(path)), [os.path.basename(path)])
+
+    def test_overlap(self):
+        """Test that submit returns while the previous file is being stored"""
+        release = threading.Event()
+        started = threading.Event()
+
+        def on_stored(*args):
+            started.set()
+            release.wait(5)
+
+        self.pipeline.on_stored = on_stored
+        self.pipeline.submit("activities", ACTIVITY, make_fit(), 4)
+        self.assertTrue(started.wait(5))
+        # One buffer may wait while the stage is busy
+        self.pipeline.submit("activities", "2013-01-02_10-00-00_4_2.fit", make_fit(), 4)
+        release.set()
+        self.pipeline.join()
+        self.assertEqual(len(self.store.list("activities")), 2)
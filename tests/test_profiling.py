@@ -0,0 +1,134 @@
+# Ant
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import array
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+from antfs_cli import archive
+from antfs_cli import index
+from antfs_cli import pipeline
+from antfs_cli import profiling
+from antfs_cli import scripting
+from tests.test_fit import make_fit
+
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.directory, "20130101-100000-antfs-cli")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cpu(self):
+        """Test that the CPU profile has a section per phase"""
+        profiler = profiling.Profiler("cpu", self.prefix)
+        profiler.start("search")
+        sorted(range(1000))
+        profiler.phase("download")
+        sum(range(1000))
+        paths = profiler.stop()
+        self.assertEqual(paths, [self.prefix + "-cpu.prof", self.prefix + "-cpu.txt"])
+        pstats.Stats(paths[0])
+        with open(paths[1]) as f:
+            report = f.read()
+        self.assertIn("=== search", report)
+        self.assertIn("=== download", report)
+
+    def test_mem(self):
+        """Test that the memory report gives the peak of each phase"""
+        profiler = profiling.Profiler("mem", self.prefix)
+        profiler.start("search")
+        data = bytearray(4 * 1024 * 1024)
+        del data
+        profiler.phase("download")
+        (path,) = profiler.stop()
+        self.assertEqual(path, self.prefix + "-mem.txt")
+        (search, _), _ = profiler.get_peaks()
+        self.assertEqual(search, "search")
+        self.assertGreaterEqual(profiler.get_peaks()[0][1], 4 * 1024 * 1024)
+
+    def test_unknown(self):
+        self.assertRaises(profiling.ProfilingError, profiling.Profiler, "io", "x")
+
+
+class SyncMemoryTest(unittest.TestCase):
+    """Regression test for the memory use of a sync"""
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        scripts = os.path.join(self.basedir, "scripts")
+        os.mkdir(scripts)
+        self.device = archive.Device(self.basedir, 1234, "Forerunner", "gzip")
+        self.index = index.Index(self.basedir)
+        self.index.update()
+        self.runner = scripting.Runner(scripts)
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def sync(self, sizes, profiler):
+        """Download and store files of the given sizes as program does, with
+        arrays for the downloaded data"""
+        store = self.device.get_storage()
+        stage = pipeline.Pipeline(store)
+        files = dict((size, make_fit(b"\x01" * size)) for size in set(sizes))
+
+        def on_stored(folder, name, fit_type, path, error, elapsed):
+            self.index.add(1234, folder, name)
+            self.runner.run_download(store.local_path(folder, name), fit_type)
+
+        stage.on_stored = on_stored
+        stage.start()
+        profiler.start("download")
+        for number, size in enumerate(sizes):
+            data = array.array("B", files[size])
+            name = "2013-01-01_10-00-{0:02}_4_{0}.fit".format(number)
+            stage.submit("activities", name, data, 4)
+            del data
+        stage.close()
+        profiler.stop()
+
+    def test_peak_memory(self):
+        """Test that the peak stays within a few times the largest file,
+        however many files are synced"""
+        largest = 64 * 1024
+        peaks = []
+        for count in (12, 48):
+            sizes = [largest // (1 + i % 4) for i in range(count)]
+            profiler = profiling.Profiler(
+                "mem", os.path.join(self.basedir, "sync{0}".format(count))
+            )
+            self.sync(sizes, profiler)
+            ((_, peak),) = profiler.get_peaks()
+            peaks.append(peak)
+            # The downloaded array and its copy, the buffers queued in the
+            # pipeline, and the one being checked, compressed and written,
+            # with room for the transient copies of these steps
+            self.assertLess(peak, 10 * largest)
+        self.assertLess(peaks[1], peaks[0] * 1.5)
+        self.assertEqual(len(self.device.get_storage().list("activities")), 48)
@@ -0,0 +1,67 @@
+# Ant
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+from antfs_cli import archive
+from antfs_cli import scripting
+
+SCRIPT = """#!{0}
+import os, sys
+with open(os.path.join(os.environ["ANTFS_CLI_DEVICE_DIR"], "out.txt"), "w") as f:
+    f.write(" ".join(sys.argv[1:]))
+"""
+
+
+class RunnerTest(unittest.TestCase):
+    """Test running scripts"""
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.device = archive.Device(self.basedir, 1234, "Forerunner", "gzip")
+        self.device.get_storage().write("activities", "a.fit", b"data")
+        directory = os.path.join(self.basedir, "scripts")
+        os.mkdir(directory)
+        script = os.path.join(directory, "40-test.py")
+        with open(script, "w") as f:
+            f.write(SCRIPT.format(sys.executable))
+        os.chmod(script, stat.S_IRWXU)
+        self.runner = scripting.Runner(directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_device_dir(self):
+        """Test that scripts given a temporary copy can find the device"""
+        local = self.device.get_storage().local_path("activities", "a.fit")
+        self.runner._run_action("DOWNLOAD", local, 4, self.device.get_path())
+        with open(os.path.join(self.device.get_path(), "out.txt")) as f:
+            action, filename, fit_type = f.read().split(" ")
+        self.assertEqual((action, fit_type), ("DOWNLOAD", "4"))
+        self.assertEqual(os.path.basename(filename), "a.fit")
+        self.assertFalse(os.path.exists(filename))
@@ -0,0 +1,99 @@
+# Ant
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import shutil
+import tempfile
+import threading
+import unittest
+
+from antfs_cli import archive
+from antfs_cli import search
+
+
+def parameters(number, seen):
+    return dict(search.WILDCARD, device_number=number, seen=seen)
+
+
+class GetRecentTest(unittest.TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        for serial, seen in ((1, 1000), (2, 3000), (3, 2000), (4, 0)):
+            device = archive.Device(self.basedir, serial, "Forerunner")
+            device.write_channel(parameters(serial * 10, seen))
+        archive.Device(self.basedir, 5, "Forerunner")
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_get_recent(self):
+        """Test that recently seen devices are returned, latest first"""
+        recent = search.get_recent(self.basedir, max_age=2500, limit=2, now=3500)
+        self.assertEqual([serial for serial, _ in recent], [2, 3])
+        self.assertEqual(recent[0][1]["device_number"], 20)
+
+
+class SearchTest(unittest.TestCase):
+    def setUp(self):
+        self.wait = search._TARGETED_WAIT
+        search._TARGETED_WAIT = 0.05
+        self.opened = []
+        self.done = threading.Event()
+
+    def tearDown(self):
+        search._TARGETED_WAIT = self.wait
+
+    def configure(self, serial, parameters, search_timeout):
+        self.opened.append((serial, parameters["device_number"], search_timeout))
+        if serial is None:
+            self.done.set()
+
+    def test_fallback(self):
+        """Test that targeted searches fall back to a wildcard search"""
+        recent = [(1, parameters(10, 0)), (2, parameters(20, 0))]
+        s = search.Search(self.configure, recent)
+        s.start()
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(
+            self.opened,
+            [
+                (1, 10, search.TARGETED_TIMEOUT),
+                (2, 20, search.TARGETED_TIMEOUT),
+                (None, 0, 255),
+            ],
+        )
+        targeted, latency = s.linked()
+        self.assertIsNone(targeted)
+        self.assertGreater(latency, 0)
+
+    def test_targeted(self):
+        """Test linking during the targeted search"""
+        s = search.Search(self.configure, [(1, parameters(10, 0))])
+        search._TARGETED_WAIT = 60
+        s.start()
+        self.assertEqual(s.linked()[0], 1)
+        self.assertEqual(self.opened, [(1, 10, search.TARGETED_TIMEOUT)])
+
+    def test_wildcard(self):
+        """Test that without known devices only a wildcard search is made"""
+        search.Search(self.configure, []).start()
+        self.assertEqual(self.opened, [(None, 0, 255)])
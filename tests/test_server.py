@@ -0,0 +1,148 @@
+# Ant
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import gzip
+import http.client
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+
+from antfs_cli import archive
+from antfs_cli import server
+
+ACTIVITY = "2013-01-01_10-00-00_4_1.fit"
+COURSE = "2013-01-02_10-00-00_6_2.fit"
+DATA = bytes(range(256)) * 4
+
+
+class ParseRangeTest(unittest.TestCase):
+    def test_parse_range(self):
+        self.assertEqual(server.parse_range("bytes=0-99", 1000), (0, 100))
+        self.assertEqual(server.parse_range("bytes=900-", 1000), (900, 1000))
+        self.assertEqual(server.parse_range("bytes=-100", 1000), (900, 1000))
+        self.assertEqual(server.parse_range("bytes=990-2000", 1000), (990, 1000))
+        self.assertIsNone(server.parse_range(None, 1000))
+        self.assertIsNone(server.parse_range("bytes=0-1,5-6", 1000))
+        self.assertRaises(server._RangeError, server.parse_range, "bytes=1000-", 1000)
+
+
+class ServerTest(unittest.TestCase):
+    """Test the HTTP API"""
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        store = archive.Device(self.basedir, 1234, "Forerunner").get_storage()
+        store.write("activities", ACTIVITY, DATA)
+        store = archive.Device(self.basedir, 1234, "Forerunner", "gzip").get_storage()
+        store.write("courses", COURSE, DATA)
+        self.httpd = server.Server(self.basedir, ("127.0.0.1", 0))
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.thread.join()
+        self.httpd.server_close()
+        shutil.rmtree(self.basedir)
+
+    def request(self, path, method="GET", **headers):
+        connection = http.client.HTTPConnection(
+            *self.httpd.server_address[:2], timeout=10
+        )
+        connection.request(method, path, headers=headers)
+        response = connection.getresponse()
+        data = response.read()
+        connection.close()
+        return response, data
+
+    def test_listing(self):
+        """Test listing devices and files, and conditional requests"""
+        response, data = self.request("/devices")
+        self.assertEqual(json.loads(data)[0]["serial"], 1234)
+        response, data = self.request("/devices/1234/files?type=activities")
+        self.assertEqual(response.status, 200)
+        (item,) = json.loads(data)
+        self.assertEqual(item["url"], "/devices/1234/files/" + ACTIVITY)
+        self.assertEqual(item["size"], len(DATA))
+        etag = response.getheader("ETag")
+        response, data = self.request(
+            "/devices/1234/files?type=activities", **{"If-None-Match": etag}
+        )
+        self.assertEqual(response.status, 304)
+        response, data = self.request("/devices/1234/files?until=2013-01-01")
+        self.assertEqual([item["name"] for item in json.loads(data)], [ACTIVITY])
+        self.assertEqual(self.request("/devices/4321/files")[0].status, 404)
+
+    def test_file(self):
+        """Test downloads with validators and ranges"""
+        response, data = self.request("/devices/1234/files/" + ACTIVITY)
+        self.assertEqual(data, DATA)
+        etag = response.getheader("ETag")
+        response, _ = self.request(
+            "/devices/1234/files/" + ACTIVITY, **{"If-None-Match": etag}
+        )
+        self.assertEqual(response.status, 304)
+        response, _ = self.request(
+            "/devices/1234/files/" + ACTIVITY,
+            **{"If-Modified-Since": response.getheader("Last-Modified") or ""},
+        )
+        response, data = self.request(
+            "/devices/1234/files/" + ACTIVITY, Range="bytes=1000-"
+        )
+        self.assertEqual(response.status, 206)
+        self.assertEqual(data, DATA[1000:])
+        self.assertEqual(response.getheader("Content-Range"), "bytes 1000-1023/1024")
+        response, data = self.request(
+            "/devices/1234/files/" + ACTIVITY, Range="bytes=1024-"
+        )
+        self.assertEqual(response.status, 416)
+        response, data = self.request("/devices/1234/files/" + ACTIVITY, "HEAD")
+        self.assertEqual(response.getheader("Content-Length"), str(len(DATA)))
+        self.assertEqual(data, b"")
+        self.assertEqual(self.request("/devices/1234/files/x.fit")[0].status, 404)
+
+    def test_compressed(self):
+        """Test that compressed files are sent as stored only if accepted"""
+        response, data = self.request(
+            "/devices/1234/files/" + COURSE, **{"Accept-Encoding": "gzip"}
+        )
+        self.assertEqual(response.getheader("Content-Encoding"), "gzip")
+        self.assertEqual(gzip.decompress(data), DATA)
+        stored = response.getheader("ETag")
+        response, data = self.request(
+            "/devices/1234/files/" + COURSE, Range="bytes=-24"
+        )
+        self.assertEqual(response.status, 206)
+        self.assertIsNone(response.getheader("Content-Encoding"))
+        self.assertNotEqual(response.getheader("ETag"), stored)
+        self.assertEqual(data, DATA[-24:])
+
+    def test_compressed_identity(self):
+        """Test a full download of a compressed file without gzip"""
+        response, data = self.request("/devices/1234/files/" + COURSE)
+        self.assertEqual(response.status, 200)
+        self.assertIsNone(response.getheader("Content-Encoding"))
+        self.assertEqual(response.getheader("Content-Length"), str(len(DATA)))
+        self.assertEqual(data, DATA)
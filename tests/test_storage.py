@@ -0,0 +1,193 @@
+# Ant
+#
+# Copyright (c) 2012, Gustav Tiger <gustav@tiger.name>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import array
+import gzip
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from antfs_cli import storage
+
+
+class StorageTest(unittest.TestCase):
+    """Test plain and compressed file storage"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.path, "activities"))
+        rand = random.Random(610)
+        self.data = bytes(
+            rand.randrange(16) for _ in range(3 * storage.FRAME_SIZE + 1234)
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_plain(self):
+        """Test that uncompressed files are stored as is"""
+        store = storage.Storage(self.path)
+        path = store.write("activities", "a.fit", array.array("B", self.data))
+        self.assertEqual(path, os.path.join(self.path, "activities", "a.fit"))
+        self.assertEqual(store.read("activities", "a.fit"), self.data)
+        with store.local_path("activities", "a.fit") as local:
+            self.assertEqual(local, path)
+
+    def test_gzip(self):
+        """Test that gzip files round trip and are readable by gzip"""
+        store = storage.Storage(self.path, "gzip")
+        path = store.write("activities", "a.fit", self.data)
+        self.assertTrue(path.endswith(".fit.gz"))
+        self.assertLess(os.path.getsize(path), len(self.data))
+        self.assertEqual(store.read("activities", "a.fit"), self.data)
+        with gzip.open(path) as fd:
+            self.assertEqual(fd.read(), self.data)
+
+    def test_gzip_seek(self):
+        """Test random access into a compressed file"""
+        store = storage.Storage(self.path, "gzip")
+        store.write("activities", "a.fit", self.data)
+        with store.open("activities", "a.fit") as fd:
+            for offset in [0, 5, storage.FRAME_SIZE - 2, 2 * storage.FRAME_SIZE]:
+                fd.seek(offset)
+                self.assertEqual(fd.read(10), self.data[offset : offset + 10])
+            fd.seek(-2, os.SEEK_END)
+            self.assertEqual(fd.read(), self.data[-2:])
+
+    def test_empty(self):
+        """Test compressing an empty file"""
+        store = storage.Storage(self.path, "gzip")
+        store.write("activities", "a.fit", b"")
+        self.assertEqual(store.read("activities", "a.fit"), b"")
+
+    def test_foreign_gzip(self):
+        """Test reading a file compressed by another tool"""
+        with gzip.open(os.path.join(self.path, "activities", "a.fit.gz"), "wb") as f:
+            f.write(self.data)
+        store = storage.Storage(self.path)
+        self.assertEqual(store.read("activities", "a.fit"), self.data)
+
+    def test_list(self):
+        """Test that files are listed by logical name"""
+        storage.Storage(self.path).write("activities", "a.fit", b"a")
+        storage.Storage(self.path, "gzip").write("activities", "b.fit", b"b")
+        open(os.path.join(self.path, "activities", "notes.txt"), "w").close()
+        store = storage.Storage(self.path)
+        self.assertEqual(sorted(store.list("activities")), ["a.fit", "b.fit"])
+        self.assertTrue(store.exists("activities", "b.fit"))
+        self.assertFalse(store.exists("activities", "c.fit"))
+        self.assertEqual(store.list("courses"), [])
+        self.assertEqual(store.migrate(["courses"]), 0)
+
+    def test_rewrite(self):
+        """Test that writing with another codec replaces the old copy"""
+        storage.Storage(self.path).write("activities", "a.fit", b"a")
+        storage.Storage(self.path, "gzip").write("activities", "a.fit", b"b")
+        self.assertEqual(
+            os.listdir(os.path.join(self.path, "activities")), ["a.fit.gz"]
+        )
+
+    def test_rename(self):
+        """Test that renaming keeps the compression"""
+        store = storage.Storage(self.path, "gzip")
+        store.write("activities", "a.fit", self.data)
+        store.rename("activities", "a.fit", "b.fit")
+        self.assertEqual(store.list("activities"), ["b.fit"])
+        self.assertEqual(store.read("activities", "b.fit"), self.data)
+
+    def test_local_path(self):
+        """Test that compressed files are temporarily decompressed"""
+        store = storage.Storage(self.path, "gzip")
+        store.write("activities", "a.fit", self.data)
+        with store.local_path("activities", "a.fit") as local:
+            self.assertFalse(local.startswith(self.path))
+            self.assertEqual(
+                local.split(os.sep)[-3:],
+                [os.path.basename(self.path), "activities", "a.fit"],
+            )
+            self.assertEqual(store.get_path("activities", "a.fit")[-3:], ".gz")
+            with open(local, "rb") as fd:
+                self.assertEqual(fd.read(), self.data)
+        self.assertFalse(os.path.exists(os.path.dirname(local)))
+        self.assertEqual(store.list("activities"), ["a.fit"])
+
+    @unittest.skipIf(storage.zstandard is None, "zstandard not installed")
+    def test_zstd(self):
+        """Test that zstd files round trip and support seeking"""
+        store = storage.Storage(self.path, "zstd")
+        path = store.write("activities", "a.fit", self.data)
+        self.assertTrue(path.endswith(".fit.zst"))
+        with store.open("activities", "a.fit") as fd:
+            fd.seek(storage.FRAME_SIZE + 7)
+            self.assertEqual(fd.read(), self.data[storage.FRAME_SIZE + 7 :])
+
+    def test_date_layout(self):
+        """Test that files are sharded by year and month"""
+        store = storage.Storage(self.path, layout="date")
+        name = "2013-04-05_10-00-00_4_1.fit"
+        path = store.write("activities", name, b"a")
+        self.assertEqual(
+            path, os.path.join(self.path, "activities", "2013", "04", name)
+        )
+        store.write("activities", "course.fit", b"b")
+        self.assertEqual(sorted(store.list("activities")), [name, "course.fit"])
+        self.assertEqual(store.read("activities", name), b"a")
+
+    def test_migrate(self):
+        """Test moving files between layouts a few at a time"""
+        names = ["2013-0{0}-01_10-00-00_4_{0}.fit".format(i) for i in range(1, 6)]
+        flat = storage.Storage(self.path)
+        for name in names:
+            flat.write("activities", name, name.encode())
+
+        sharded = storage.Storage(self.path, layout="date")
+        self.assertEqual(sharded.migrate(["activities"], limit=2), 2)
+        # Half migrated, every file is still found
+        self.assertEqual(sorted(sharded.list("activities")), names)
+        for name in names:
+            self.assertEqual(sharded.read("activities", name), name.encode())
+        self.assertEqual(sharded.migrate(["activities"]), 3)
+        self.assertEqual(sharded.migrate(["activities"]), 0)
+        self.assertEqual(os.listdir(os.path.join(self.path, "activities")), ["2013"])
+
+        # And back again
+        self.assertEqual(flat.migrate(["activities"]), 5)
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.path, "activities"))), names
+        )
+
+    def test_migration_thread(self):
+        """Test the background migration"""
+        name = "2013-04-05_10-00-00_4_1.fit"
+        storage.Storage(self.path).write("activities", name, b"a")
+        migration = storage.Migration(
+            storage.Storage(self.path, layout="date"), ["activities"]
+        )
+        migration.start()
+        migration.join()
+        self.assertEqual(migration.get_moved(), 1)
+
+    def test_unknown_codec(self):
+        """Test that unknown compression is rejected"""
+        self.assertRaises(storage.StorageError, storage.Storage, self.path, "lzma")